@@ -1,6 +1,9 @@
+from lazy_init import STARTUP, ProcessLocal
 import os
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+import json
+import hashlib
+from flask import Flask, Response, request, abort, jsonify
+from linebot import WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
@@ -8,27 +11,76 @@ from linebot.models import (
     ButtonComponent, TextComponent, RichMenu, RichMenuArea, RichMenuBounds, RichMenuSize
 )
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from dotenv import dotenv_values
-import xml.etree.ElementTree as ET
-from datetime import datetime
-import requests
+import http_client
+from http_client import PooledLineHttpClient
+from line_client import RateLimitedLineBotApi
+from event_dispatcher import EventDispatcher, KeyedExecutor
+from local_cache import TTLCache
+from session_store import create_session_store
+from message_cache import PrebuiltMessage, VersionedMessageCache
+from metrics import REGISTRY, CONTENT_TYPE
+from news_feed import FEED_URL, FeedCache, FeedFetcher, FeedIndex, parse_feed
+
+STARTUP.mark("import:libraries")
 
 app = Flask(__name__)
 
+# 各階段耗時與事件計數，由 /metrics 以 Prometheus 文字格式輸出（每個worker行程各自統計）
+STAGE_SECONDS = REGISTRY.summary('webhook_stage_seconds', 'webhook各處理階段的耗時（秒）')
+EVENTS_TOTAL = REGISTRY.counter('webhook_events_total', '依類型統計的webhook事件數')
+COMMANDS_TOTAL = REGISTRY.counter('webhook_commands_total', '依指令統計的文字訊息數')
+PREFERENCE_CACHE_TOTAL = REGISTRY.counter('preference_cache_lookups_total', '使用者偏好快取的命中統計')
+
+class InstrumentedLineBotApi(RateLimitedLineBotApi):
+    """記錄回覆訊息耗時的 LineBotApi（含速率限制與重試）"""
+    
+    def reply_message(self, reply_token, messages, *args, **kwargs):
+        with STAGE_SECONDS.time(stage="line_reply"):
+            return super().reply_message(reply_token, messages, *args, **kwargs)
+
 # 載入環境變數
 config = dotenv_values("./.env")
 LINE_CHANNEL_SECRET = config.get('LINE_CHANNEL_SECRET')
 LINE_CHANNEL_ACCESS_TOKEN = config.get('LINE_CHANNEL_ACCESS_TOKEN')
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+
+# 所有對外HTTP請求共用連線池與逾時設定
+http_client.configure(
+    connect_timeout=float(config.get('HTTP_CONNECT_TIMEOUT') or 5),
+    read_timeout=float(config.get('HTTP_READ_TIMEOUT') or 15),
+    pool_maxsize=int(config.get('HTTP_POOL_MAXSIZE') or 10)
+)
+
+# 預熱：worker啟動後預先建立連線並載入Feed（見 warm_up）
+WARMUP_ON_START = (config.get('WARMUP_ON_START') or '').lower() in ('1', 'true', 'yes')
+
+# LINE 與 MongoDB 用戶端在每個行程第一次使用時才建立，
+# 避免在gunicorn master建立後被fork到各個worker共用socket
+line_bot_api = ProcessLocal(
+    'line_bot_api',
+    lambda: InstrumentedLineBotApi(
+        LINE_CHANNEL_ACCESS_TOKEN,
+        rate=float(config.get('LINE_API_RATE') or 200),
+        burst=int(config.get('LINE_API_BURST') or 0) or None,
+        max_retries=int(config.get('LINE_API_MAX_RETRIES') or 3),
+        http_client=PooledLineHttpClient
+    ),
+    STARTUP
+)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
 # 設定 MongoDB Atlas
 mongo_uri = config.get('MONGODB_URI')
 mongo_db = config.get('MONGODB_DB')
-client = MongoClient(mongo_uri)
-db = client[mongo_db]
-users_collection = db['users']
+mongo_client = ProcessLocal('mongo_client', lambda: MongoClient(mongo_uri), STARTUP)
+users_collection = ProcessLocal('users_collection', lambda: mongo_client.get()[mongo_db]['users'])
+
+# 本行程的使用者偏好快取，由偏好寫入操作同步更新
+preference_cache = TTLCache(
+    max_size=int(config.get('PREFERENCE_CACHE_SIZE') or 10000),
+    ttl=int(config.get('PREFERENCE_CACHE_TTL') or 60)
+)
 
 # 定義新聞類別
 NEWS_CATEGORIES = [
@@ -37,8 +89,70 @@ NEWS_CATEGORIES = [
     "藝文", "旅遊", "專題"
 ]
 
-# 全局變量來跟踪用戶上下文
-user_context = {}
+# 文字訊息可用的指令
+KNOWN_COMMANDS = {"類別搜尋", "偏好設定", "幫助", "全選偏好", "清除偏好", *NEWS_CATEGORIES}
+
+# 跟踪用戶上下文（搜尋或偏好設定模式），有容量上限與存活時間；
+# SESSION_BACKEND=sqlite 時多個worker行程共用同一份上下文
+user_context = create_session_store(
+    backend=config.get('SESSION_BACKEND') or "memory",
+    path=config.get('SESSION_DB_PATH') or "./sessions.db",
+    max_size=int(config.get('SESSION_MAX_SIZE') or 10000),
+    ttl=int(config.get('SESSION_TTL') or 1800)
+)
+
+STARTUP.mark("import:config")
+
+def dispatch_event(event):
+    """依事件類型分派給對應的處理函式，並記錄處理耗時"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        EVENTS_TOTAL.inc(type="message")
+        with STAGE_SECONDS.time(stage="handle_message"):
+            handle_message(event)
+    elif isinstance(event, PostbackEvent):
+        EVENTS_TOTAL.inc(type="postback")
+        with STAGE_SECONDS.time(stage="handle_postback"):
+            handle_postback(event)
+    else:
+        EVENTS_TOTAL.inc(type=getattr(event, 'type', None) or "unknown")
+
+# 同一批webhook中的多個事件以執行緒池並行處理，同一使用者的事件依序處理
+batch_executor = KeyedExecutor(workers=int(config.get('WEBHOOK_BATCH_WORKERS') or 8))
+
+def dispatch_events(events):
+    """處理一批webhook事件
+    
+    只有一個事件時直接處理；多個事件時依使用者分組並行處理，並等待全部完成，
+    讓回覆仍在 reply token 有效期間內送出。
+    
+    @param events: 事件列表
+    """
+    if len(events) <= 1:
+        for event in events:
+            dispatch_event(event)
+        return
+    
+    with STAGE_SECONDS.time(stage="dispatch_batch"):
+        futures = [
+            batch_executor.submit(getattr(event.source, 'user_id', None), dispatch_event, event)
+            for event in events
+        ]
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                print(f"處理webhook事件時發生錯誤: {error}")
+
+# 非同步webhook處理：WEBHOOK_ASYNC 啟用時由執行緒池處理事件
+if (config.get('WEBHOOK_ASYNC') or '').lower() in ('1', 'true', 'yes'):
+    event_dispatcher = EventDispatcher(
+        dispatch_events,
+        workers=int(config.get('WEBHOOK_WORKERS') or 4),
+        queue_size=int(config.get('WEBHOOK_QUEUE_SIZE') or 100),
+        put_timeout=float(config.get('WEBHOOK_QUEUE_TIMEOUT') or 1.0)
+    )
+    REGISTRY.gauge('webhook_queue_pending', '非同步佇列中等待處理的webhook批次數', event_dispatcher.pending)
+else:
+    event_dispatcher = None
 
 @app.route("/callback", methods=['POST'])
 def callback():
@@ -51,25 +165,46 @@ def callback():
 
     # 處理 webhook 回調
     try:
-        handler.handle(body, signature)
+        with STAGE_SECONDS.time(stage="signature"):
+            events = handler.parser.parse(body, signature)
+        
+        # 非同步模式交給背景執行緒處理並立即回應；
+        # 同步模式或佇列已滿時由目前請求直接處理（佇列已滿時藉此減緩接收速度）
+        if event_dispatcher is None or not event_dispatcher.submit(events):
+            dispatch_events(events)
     except InvalidSignatureError:
         abort(400)
 
     return 'OK'
 
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """以 Prometheus 文字格式輸出各階段耗時與計數"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route("/feed_status", methods=['GET'])
+def feed_status():
+    """回傳新聞Feed快取狀態（包含快取存在秒數）與HTTP連線池統計"""
+    status = feed_cache.status()
+    status["http_pools"] = http_client.pool_stats()
+    return jsonify(status)
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     text = event.message.text
     user_id = event.source.user_id
     reply_token = event.reply_token
     
+    # 只統計已知的指令與類別，避免任意文字產生過多標籤
+    COMMANDS_TOTAL.inc(command=text if text in KNOWN_COMMANDS else "other")
+    
     if text == "類別搜尋":
         # 顯示類別搜尋選單
-        user_context[user_id] = "category_search"  # 設置上下文為搜尋模式
+        user_context.set(user_id, "category_search")  # 設置上下文為搜尋模式
         show_category_search(reply_token)
     elif text == "偏好設定":
         # 顯示偏好設定選單
-        user_context[user_id] = "preference_setting"  # 設置上下文為偏好設定模式
+        user_context.set(user_id, "preference_setting")  # 設置上下文為偏好設定模式
         show_preference_settings(reply_token, user_id)
     elif text == "幫助":
         # 顯示幫助信息
@@ -97,10 +232,11 @@ def handle_message(event):
             if context == "category_search":
                 # 搜尋該類別的新聞
                 try:
-                    news_list = get_news_by_category(text, 10)  # 獲取最新10篇新聞
-                    if news_list:
+                    # 獲取最新10篇新聞的Flex訊息（同一Feed版本共用快取）
+                    message = get_category_news_message(text, 10)
+                    if message:
                         # 顯示新聞列表
-                        show_news_list(reply_token, text, news_list)
+                        line_bot_api.reply_message(reply_token, message)
                     else:
                         line_bot_api.reply_message(
                             reply_token,
@@ -115,9 +251,8 @@ def handle_message(event):
                         TextSendMessage(text=f"獲取新聞時發生錯誤，請稍後再試。")
                     )
             else:
-                # 切換偏好設定
-                toggle_user_preference(user_id, text)
-                user_prefs = get_user_preferences(user_id)
+                # 切換偏好設定，並直接取得切換後的偏好
+                user_prefs = toggle_user_preference(user_id, text)
                 if text in user_prefs:
                     message = f"已新增「{text}」到您的偏好！"
                 else:
@@ -143,10 +278,8 @@ def handle_postback(event):
     if data.startswith('category_'):
         # 處理類別選擇
         category = data.replace('category_', '')
-        toggle_user_preference(user_id, category)
-        
-        # 取得使用者目前偏好
-        user_prefs = get_user_preferences(user_id)
+        # 切換偏好並取得使用者目前偏好
+        user_prefs = toggle_user_preference(user_id, category)
         if category in user_prefs:
             message = f"已新增「{category}」到您的偏好！"
         else:
@@ -160,81 +293,68 @@ def handle_postback(event):
         # 顯示設定偏好的詳細選單
         show_preference_details(reply_token, user_id)
 
-def get_news_by_category(category, count=10):
-    """從自定義XML RSS源獲取指定類別的最新新聞"""
-    try:
-        # 獲取RSS內容
-        response = requests.get("https://news.cts.com.tw/api/lineToday.xml")
-        
-        if response.status_code != 200:
-            print(f"獲取RSS失敗: {response.status_code}")
-            return []
-        
-        # 解析XML
-        xml_content = response.text
-        
-        # 使用ElementTree解析XML
-        root = ET.fromstring(xml_content)
-        
-        # 找到所有文章
-        articles = root.findall('.//article')
-        
-        news_list = []
-        for article in articles:
-            # 獲取文章類別
-            article_category = article.find('category')
-            if article_category is not None and article_category.text == category:
-                # 提取文章信息
-                title_elem = article.find('title')
-                title = title_elem.text if title_elem is not None else "無標題"
-                
-                # 清理CDATA
-                if title and '![CDATA[' in title:
-                    title = title.replace('![CDATA[', '').replace(']]>', '')
-                
-                # 獲取ID
-                id_elem = article.find('ID')
-                article_id = id_elem.text if id_elem is not None else ""
-                
-                # 構建鏈接
-                link = f"https://news.cts.com.tw/cts/politics/{article_id[:6]}/{article_id}.html"
-                
-                # 獲取縮略圖
-                thumbnail_elem = article.find('thumbnail')
-                thumbnail = thumbnail_elem.text if thumbnail_elem is not None else ""
-                
-                # 獲取發布時間
-                publish_time_elem = article.find('publishTimeUnix')
-                publish_time = ""
-                if publish_time_elem is not None and publish_time_elem.text:
-                    try:
-                        # 轉換Unix時間戳為可讀時間
-                        timestamp = int(publish_time_elem.text) / 1000  # 轉為秒
-                        publish_time = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
-                    except:
-                        publish_time = ""
-                
-                news_list.append({
-                    "title": title,
-                    "link": link,
-                    "published": publish_time,
-                    "thumbnail": thumbnail,
-                    "category": category
-                })
-                
-                # 如果已經找到足夠數量的新聞，停止查找
-                if len(news_list) >= count:
-                    break
-        
-        return news_list
-    except Exception as e:
-        print(f"解析RSS時發生錯誤: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
+# 建立索引時最多保留的新聞數量，避免Feed變大時記憶體與解析時間跟著成長
+FEED_MAX_ARTICLES = int(config.get('FEED_MAX_ARTICLES') or 0) or None
+
+def build_feed_index(xml_content):
+    """解析RSS內容並建立類別索引"""
+    return FeedIndex(parse_feed(xml_content, limit=FEED_MAX_ARTICLES))
+
+# 以條件式請求下載RSS，Feed未更新時沿用上一次的索引
+feed_fetcher = FeedFetcher(build_feed_index, FEED_URL)
+
+def load_feed():
+    """Feed快取的載入函式，記錄下載與解析耗時"""
+    with STAGE_SECONDS.time(stage="feed_fetch"):
+        return feed_fetcher.fetch()
+
+# 各類別新聞列表訊息的快取，Feed版本改變時失效
+news_message_cache = VersionedMessageCache()
+
+# 行程內共用的Feed快取，同時過期的請求只會觸發一次下載，並由背景執行緒定期更新
+feed_cache = FeedCache(
+    load_feed,
+    ttl=int(config.get('FEED_CACHE_TTL') or 60),
+    refresh_interval=int(config.get('FEED_REFRESH_INTERVAL') or 30)
+)
+
+REGISTRY.gauge('startup_phase_seconds', '本行程啟動各階段的耗時（秒）', STARTUP.snapshot)
+REGISTRY.gauge('feed_snapshot_age_seconds', '目前Feed快取的存在秒數', feed_cache.age)
+REGISTRY.gauge(
+    'http_pool_requests',
+    '共用HTTP連線池的請求數（hit為重用連線，miss為新建連線）',
+    lambda: {
+        (("host", host), ("result", result)): stats[field]
+        for host, stats in http_client.pool_stats().items()
+        for result, field in (("hit", "hits"), ("miss", "misses"))
+    }
+)
+
+def get_category_news_message(category, count=10):
+    """取得指定類別的新聞列表訊息
+    
+    同一個Feed版本下，每個類別的訊息只建立一次，之後直接回傳快取
+    
+    @return: 訊息物件，該類別沒有新聞時回傳None
+    """
+    with STAGE_SECONDS.time(stage="feed_lookup"):
+        feed = feed_cache.get()
+    if not feed:
+        return None
+    
+    return news_message_cache.get(
+        feed.version,
+        (category, count),
+        lambda: build_news_list_message(category, feed.latest(category, count))
+    )
 
-def show_news_list(reply_token, category, news_list):
-    """顯示新聞列表，使用提供的樣式模板"""
+def build_news_list_message(category, news_list):
+    """建立新聞列表的Flex訊息
+    
+    @return: 預先轉為JSON的訊息物件，沒有新聞時回傳None
+    """
+    if not news_list:
+        return None
     
     bubble = {
         "type": "bubble",
@@ -278,7 +398,7 @@ def show_news_list(reply_token, category, news_list):
                     "contents": [
                         {
                             "type": "image",
-                            "url": news.get('thumbnail') if news.get('thumbnail') else "https://via.placeholder.com/100x100.png?text=CTS+News",
+                            "url": news.thumbnail or "https://via.placeholder.com/100x100.png?text=CTS+News",
                             "aspectMode": "cover",
                             "aspectRatio": "1:1",
                             "size": "full"
@@ -319,7 +439,7 @@ def show_news_list(reply_token, category, news_list):
                         # 標題
                         {
                             "type": "text",
-                            "text": news.get('title', ''),
+                            "text": news.title,
                             "size": "sm",
                             "color": "#111111",
                             "margin": "sm",
@@ -348,7 +468,7 @@ def show_news_list(reply_token, category, news_list):
             "action": {
                 "type": "uri",
                 "label": "action",
-                "uri": news.get('link', 'https://news.cts.com.tw/')
+                "uri": news.link or 'https://news.cts.com.tw/'
             }
         }
         
@@ -362,16 +482,15 @@ def show_news_list(reply_token, category, news_list):
         else:
             news_container["contents"].append(news_box)
     
-    # 創建並發送Flex消息
-    flex_message = FlexSendMessage(
-        alt_text=f"{category}類別新聞",
-        contents=bubble
-    )
-    
-    line_bot_api.reply_message(reply_token, flex_message)
+    # 直接建立Flex訊息的JSON，不經過SDK的物件轉換
+    return PrebuiltMessage({
+        "type": "flex",
+        "altText": f"{category}類別新聞",
+        "contents": bubble
+    })
 
-def show_category_search(reply_token):
-    """顯示類別搜尋選單，使用橫向泡泡"""
+def build_category_search_message():
+    """建立類別搜尋選單，使用橫向泡泡（啟動時建立一次）"""
     # 將類別分組，分別為5、5、5
     category_groups = [
         NEWS_CATEGORIES[0:5],
@@ -422,23 +541,23 @@ def show_category_search(reply_token):
         }
     )
     
-    line_bot_api.reply_message(reply_token, carousel_message)
+    return PrebuiltMessage(carousel_message.as_json_dict())
 
-def show_preference_settings(reply_token, user_id):
-    """顯示偏好設定選單，顯示目前偏好和設定按鈕"""
-    user_prefs = get_user_preferences(user_id)
-    
-    if not user_prefs:
-        pref_text = "您尚未設定任何偏好"
-    else:
-        pref_text = "• " + "\n• ".join(user_prefs)
-    
+# 類別搜尋選單內容固定，啟動時建立一次
+CATEGORY_SEARCH_MESSAGE = build_category_search_message()
+
+def show_category_search(reply_token):
+    """顯示類別搜尋選單，使用橫向泡泡"""
+    line_bot_api.reply_message(reply_token, CATEGORY_SEARCH_MESSAGE)
+
+def build_preference_settings_template():
+    """建立偏好設定選單的樣板，偏好文字於回覆時填入（啟動時建立一次）"""
     bubble = BubbleContainer(
         body=BoxComponent(
             layout="vertical",
             contents=[
                 TextComponent(text="您目前的偏好設定", weight="bold", size="xl", margin="md"),
-                TextComponent(text=pref_text, wrap=True, margin="md"),
+                TextComponent(text="-", wrap=True, margin="md"),
                 BoxComponent(
                     layout="vertical",
                     margin="lg",
@@ -483,38 +602,61 @@ def show_preference_settings(reply_token, user_id):
         contents=bubble
     )
     
-    line_bot_api.reply_message(reply_token, message)
+    return message.as_json_dict()
 
-def show_preference_details(reply_token, user_id):
-    """顯示詳細的偏好設定選單"""
+PREFERENCE_SETTINGS_TEMPLATE = build_preference_settings_template()
+
+def show_preference_settings(reply_token, user_id):
+    """顯示偏好設定選單，顯示目前偏好和設定按鈕"""
     user_prefs = get_user_preferences(user_id)
     
-    bubbles = []
+    if not user_prefs:
+        pref_text = "您尚未設定任何偏好"
+    else:
+        pref_text = "• " + "\n• ".join(user_prefs)
     
-    # 將類別分組，每組5個
-    category_groups = [NEWS_CATEGORIES[i:i+5] for i in range(0, len(NEWS_CATEGORIES), 5)]
+    # 只替換偏好文字，其餘內容共用樣板
+    template = PREFERENCE_SETTINGS_TEMPLATE
+    body = template["contents"]["body"]
+    title, pref_text_tpl, buttons = body["contents"]
     
-    for group in category_groups:
-        category_buttons = []
-        
-        for category in group:
-            # 檢查該類別是否已被選擇
-            is_selected = category in user_prefs
-            color = "#1DB446" if is_selected else "#aaaaaa"
-            prefix = "✓ " if is_selected else ""
-            
-            category_buttons.append(
-                ButtonComponent(
-                    style="primary" if is_selected else "secondary",
-                    color=color,
-                    action=MessageAction(
-                        label=f"{prefix}{category}", 
-                        text=category
-                    ),
-                    height="sm"
-                )
-            )
-        
+    line_bot_api.reply_message(reply_token, PrebuiltMessage({
+        **template,
+        "contents": {
+            **template["contents"],
+            "body": {**body, "contents": [title, {**pref_text_tpl, "text": pref_text}, buttons]}
+        }
+    }))
+
+# 偏好選單中的類別分組，每組5個
+PREFERENCE_CATEGORY_GROUPS = [NEWS_CATEGORIES[i:i+5] for i in range(0, len(NEWS_CATEGORIES), 5)]
+
+def build_preference_button(category, is_selected):
+    """建立偏好選單中單一類別的按鈕（已選取與未選取兩種狀態）"""
+    color = "#1DB446" if is_selected else "#aaaaaa"
+    prefix = "✓ " if is_selected else ""
+    
+    return ButtonComponent(
+        style="primary" if is_selected else "secondary",
+        color=color,
+        action=MessageAction(
+            label=f"{prefix}{category}", 
+            text=category
+        ),
+        height="sm"
+    ).as_json_dict()
+
+# 每個類別預先建立「未選取」與「已選取」兩種按鈕，以 is_selected 為索引
+PREFERENCE_BUTTONS = {
+    category: (build_preference_button(category, False), build_preference_button(category, True))
+    for category in NEWS_CATEGORIES
+}
+
+def build_preference_details_template():
+    """建立詳細偏好設定選單的樣板，類別按鈕於回覆時依選取狀態填入（啟動時建立一次）"""
+    bubbles = []
+    
+    for group in PREFERENCE_CATEGORY_GROUPS:
         # 創建一個氣泡
         bubble = BubbleContainer(
             body=BoxComponent(
@@ -526,7 +668,7 @@ def show_preference_details(reply_token, user_id):
                         layout="vertical",
                         margin="lg",
                         spacing="sm",
-                        contents=category_buttons
+                        contents=[]
                     )
                 ]
             ),
@@ -563,69 +705,122 @@ def show_preference_details(reply_token, user_id):
         }
     )
     
-    line_bot_api.reply_message(reply_token, carousel_message)
+    return carousel_message.as_json_dict()
+
+PREFERENCE_DETAILS_TEMPLATE = build_preference_details_template()
+
+def build_preference_details_message(user_prefs):
+    """依使用者偏好組合詳細偏好設定選單，只替換類別按鈕的選取狀態"""
+    selected = set(user_prefs)
+    template = PREFERENCE_DETAILS_TEMPLATE
+    
+    bubbles = []
+    for bubble, group in zip(template["contents"]["contents"], PREFERENCE_CATEGORY_GROUPS):
+        body = bubble["body"]
+        title, hint, button_box = body["contents"]
+        buttons = [PREFERENCE_BUTTONS[category][category in selected] for category in group]
+        bubbles.append({
+            **bubble,
+            "body": {**body, "contents": [title, hint, {**button_box, "contents": buttons}]}
+        })
+    
+    return PrebuiltMessage({
+        **template,
+        "contents": {**template["contents"], "contents": bubbles}
+    })
+
+def show_preference_details(reply_token, user_id):
+    """顯示詳細的偏好設定選單"""
+    user_prefs = get_user_preferences(user_id)
+    line_bot_api.reply_message(reply_token, build_preference_details_message(user_prefs))
+
+HELP_TEXT = (
+    "📰 新聞偏好機器人使用指南 📰\n\n"
+    "【功能說明】\n"
+    "本機器人可以幫您追蹤感興趣的新聞類別，設定個人化的新聞偏好。\n\n"
+    "【主選單功能】\n"
+    "• 類別搜尋：瀏覽所有新聞類別\n"
+    "• 偏好設定：查看和修改您的新聞偏好\n"
+    "• 幫助：顯示此使用說明\n\n"
+    "【指令說明】\n"
+    "• 「全選偏好」：選擇所有新聞類別\n"
+    "• 「清除偏好」：清除所有新聞偏好\n\n"
+    "【操作提示】\n"
+    "• 點擊類別名稱可切換該類別的選取狀態\n"
+    "• 您可隨時通過底部選單進入各功能\n"
+    "• 偏好設定會自動保存在系統中\n\n"
+    "如有任何問題，請與我們的客服團隊聯繫。"
+)
+
+HELP_MESSAGE = PrebuiltMessage(TextSendMessage(text=HELP_TEXT).as_json_dict())
 
 def show_help(reply_token):
     """顯示幫助信息"""
-    help_text = (
-        "📰 新聞偏好機器人使用指南 📰\n\n"
-        "【功能說明】\n"
-        "本機器人可以幫您追蹤感興趣的新聞類別，設定個人化的新聞偏好。\n\n"
-        "【主選單功能】\n"
-        "• 類別搜尋：瀏覽所有新聞類別\n"
-        "• 偏好設定：查看和修改您的新聞偏好\n"
-        "• 幫助：顯示此使用說明\n\n"
-        "【指令說明】\n"
-        "• 「全選偏好」：選擇所有新聞類別\n"
-        "• 「清除偏好」：清除所有新聞偏好\n\n"
-        "【操作提示】\n"
-        "• 點擊類別名稱可切換該類別的選取狀態\n"
-        "• 您可隨時通過底部選單進入各功能\n"
-        "• 偏好設定會自動保存在系統中\n\n"
-        "如有任何問題，請與我們的客服團隊聯繫。"
-    )
-    
-    line_bot_api.reply_message(
-        reply_token,
-        TextSendMessage(text=help_text)
-    )
+    line_bot_api.reply_message(reply_token, HELP_MESSAGE)
 
 def get_user_preferences(user_id):
-    """從MongoDB獲取使用者偏好"""
-    user = users_collection.find_one({"user_id": user_id})
-    if user:
-        return user.get("preferences", [])
-    return []
+    """從MongoDB獲取使用者偏好（優先使用本行程的偏好快取）"""
+    cached = preference_cache.get(user_id)
+    if cached is not None:
+        PREFERENCE_CACHE_TOTAL.inc(result="hit")
+        return list(cached)
+    
+    PREFERENCE_CACHE_TOTAL.inc(result="miss")
+    with STAGE_SECONDS.time(stage="mongo_get_preferences"):
+        user = users_collection.find_one({"user_id": user_id}, {"preferences": 1, "_id": 0})
+    preferences = user.get("preferences", []) if user else []
+    preference_cache.set(user_id, tuple(preferences))
+    return list(preferences)
 
 def update_user_preferences(user_id, preferences):
     """更新使用者偏好到MongoDB"""
-    users_collection.update_one(
-        {"user_id": user_id},
-        {"$set": {"preferences": preferences}},
-        upsert=True
-    )
+    with STAGE_SECONDS.time(stage="mongo_update_preferences"):
+        users_collection.update_one(
+            {"user_id": user_id},
+            {"$set": {"preferences": preferences}},
+            upsert=True
+        )
+    preference_cache.set(user_id, tuple(preferences))
 
 def toggle_user_preference(user_id, category):
-    """切換使用者對特定類別的偏好"""
-    user_prefs = get_user_preferences(user_id)
+    """切換使用者對特定類別的偏好
     
-    if category in user_prefs:
-        user_prefs.remove(category)
-    else:
-        user_prefs.append(category)
+    以管線更新在伺服器端判斷要加入或移除，並直接取得更新後的文件；
+    不依本行程的快取判斷，其他worker或同時的點擊不會讓切換方向錯誤。
+    快取只用於讀取，並以更新後的文件刷新。
     
-    update_user_preferences(user_id, user_prefs)
-
-def create_rich_menu():
-    """創建圖文選單"""
-    # 使用現有的圖文選單背景圖片
-    background_image_path = "richmenu.png"
+    @return: 切換後的偏好列表
+    """
+    current = {"$ifNull": ["$preferences", []]}
+    update = [{"$set": {"preferences": {"$cond": [
+        {"$in": [category, current]},
+        {"$filter": {"input": current, "cond": {"$ne": ["$$this", category]}}},
+        {"$concatArrays": [current, [category]]}
+    ]}}}]
     
-    # 建立圖文選單
-    rich_menu_to_create = RichMenu(
+    with STAGE_SECONDS.time(stage="mongo_toggle_preference"):
+        user = users_collection.find_one_and_update(
+            {"user_id": user_id},
+            update,
+            projection={"preferences": 1, "_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    preferences = user.get("preferences", []) if user else []
+    preference_cache.set(user_id, tuple(preferences))
+    return list(preferences)
+
+# 圖文選單背景圖片與本機狀態檔（記錄目前預設選單的內容雜湊）
+RICH_MENU_IMAGE_PATH = "richmenu.png"
+RICH_MENU_NAME = "新聞機器人選單"
+RICH_MENU_STATE_PATH = config.get('RICH_MENU_STATE_PATH') or "./.richmenu_state.json"
+
+def build_rich_menu(name=RICH_MENU_NAME):
+    """建立圖文選單定義"""
+    return RichMenu(
         size=RichMenuSize(width=2500, height=843),
         selected=True,  # 預設顯示
-        name="新聞機器人選單",  # 選單名稱，管理用，使用者不會看到
+        name=name,  # 選單名稱，管理用，使用者不會看到
         chat_bar_text="開啟選單",  # 選單按鈕文字
         areas=[
             # 左區域：類別搜尋
@@ -645,14 +840,58 @@ def create_rich_menu():
             )
         ]
     )
+
+def rich_menu_hash(image_bytes):
+    """計算圖文選單定義與圖片的內容雜湊"""
+    definition = json.dumps(build_rich_menu().as_json_dict(), sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha256(definition.encode('utf-8'))
+    digest.update(image_bytes)
+    return digest.hexdigest()[:16]
+
+def rich_menu_name(menu_hash):
+    """將內容雜湊附加在選單名稱中，讓其他實例可從LINE端比對"""
+    return f"{RICH_MENU_NAME}#{menu_hash}"
+
+def load_rich_menu_state():
+    """讀取本機記錄的圖文選單狀態"""
+    try:
+        with open(RICH_MENU_STATE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_rich_menu_state(menu_hash, rich_menu_id):
+    """記錄目前預設圖文選單的內容雜湊與ID"""
+    tmp_path = RICH_MENU_STATE_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"hash": menu_hash, "rich_menu_id": rich_menu_id}, f)
+    os.replace(tmp_path, RICH_MENU_STATE_PATH)
+
+def get_default_rich_menu_name():
+    """取得LINE端目前預設圖文選單的 (ID, 名稱)，沒有預設選單時回傳 (None, None)"""
+    try:
+        rich_menu_id = line_bot_api.get_default_rich_menu()
+    except LineBotApiError as e:
+        if e.status_code == 404:
+            return None, None
+        raise
+    if not rich_menu_id:
+        return None, None
+    return rich_menu_id, line_bot_api.get_rich_menu(rich_menu_id).name
+
+def create_rich_menu(image_bytes=None, name=RICH_MENU_NAME):
+    """創建圖文選單，上傳圖片並設定為預設選單"""
+    if image_bytes is None:
+        # 使用現有的圖文選單背景圖片
+        with open(RICH_MENU_IMAGE_PATH, 'rb') as f:
+            image_bytes = f.read()
     
     # 創建選單並獲取ID
-    rich_menu_id = line_bot_api.create_rich_menu(rich_menu_to_create)
+    rich_menu_id = line_bot_api.create_rich_menu(build_rich_menu(name))
     print(f"成功創建圖文選單，ID: {rich_menu_id}")
     
     # 上傳圖文選單圖片
-    with open(background_image_path, 'rb') as f:
-        line_bot_api.set_rich_menu_image(rich_menu_id, "image/png", f)
+    line_bot_api.set_rich_menu_image(rich_menu_id, "image/png", image_bytes)
     print("成功上傳圖文選單圖片")
     
     # 設定為預設圖文選單
@@ -661,8 +900,45 @@ def create_rich_menu():
     
     return rich_menu_id
 
+def provision_rich_menu():
+    """確保預設圖文選單與目前的定義和圖片一致
+    
+    內容雜湊與本機記錄相同時不做任何網路請求；本機沒有記錄時只查詢LINE端的預設選單，
+    名稱中的雜湊相同即沿用。只有內容改變時才建立新選單，並刪除被取代的舊選單。
+    
+    @return: 預設圖文選單ID
+    """
+    with open(RICH_MENU_IMAGE_PATH, 'rb') as f:
+        image_bytes = f.read()
+    menu_hash = rich_menu_hash(image_bytes)
+    
+    state = load_rich_menu_state()
+    if state.get("hash") == menu_hash and state.get("rich_menu_id"):
+        print(f"圖文選單未變更，沿用 ID: {state['rich_menu_id']}")
+        return state["rich_menu_id"]
+    
+    name = rich_menu_name(menu_hash)
+    current_id, current_name = get_default_rich_menu_name()
+    if current_id and current_name == name:
+        print(f"LINE端的預設圖文選單與目前定義相同，沿用 ID: {current_id}")
+        save_rich_menu_state(menu_hash, current_id)
+        return current_id
+    
+    rich_menu_id = create_rich_menu(image_bytes, name)
+    save_rich_menu_state(menu_hash, rich_menu_id)
+    
+    # 刪除被取代的舊選單，避免頻道上累積重複的圖文選單
+    if current_id and current_name and current_name.startswith(RICH_MENU_NAME):
+        try:
+            line_bot_api.delete_rich_menu(current_id)
+            print(f"已刪除舊的圖文選單，ID: {current_id}")
+        except LineBotApiError as e:
+            print(f"刪除舊的圖文選單時發生錯誤: {e}")
+    
+    return rich_menu_id
+
 def initialize_app():
-    """初始化應用，建立圖文選單"""
+    """初始化應用，確保圖文選單為最新版本"""
     try:
         # 檢查是否要刪除現有的圖文選單
         should_delete_existing = False  # 設為 True 如果你想刪除現有選單
@@ -673,17 +949,45 @@ def initialize_app():
             for rich_menu in rich_menu_list:
                 line_bot_api.delete_rich_menu(rich_menu.rich_menu_id)
                 print(f"已刪除圖文選單，ID: {rich_menu.rich_menu_id}")
+            if os.path.exists(RICH_MENU_STATE_PATH):
+                os.remove(RICH_MENU_STATE_PATH)
         
-        # 創建新的圖文選單
-        rich_menu_id = create_rich_menu()
+        # 內容未變更時不會呼叫任何LINE API
+        rich_menu_id = provision_rich_menu()
         if rich_menu_id:
-            print(f"成功創建並設定圖文選單，ID: {rich_menu_id}")
+            print(f"圖文選單已就緒，ID: {rich_menu_id}")
         else:
             print("無法創建圖文選單")
     except Exception as e:
         print(f"初始化圖文選單時發生錯誤: {e}")
 
+def warm_up():
+    """預熱目前行程：建立LINE與MongoDB用戶端、確認資料庫連線並載入Feed
+    
+    需在fork之後呼叫（例如 gunicorn.conf.py 的 post_worker_init），
+    讓第一個請求不必承擔建立連線與下載Feed的成本。
+    """
+    with STARTUP.phase("warm_up"):
+        line_bot_api.get()
+        try:
+            with STARTUP.phase("warm_up:mongo_ping"):
+                mongo_client.admin.command('ping')
+        except Exception as e:
+            print(f"預熱MongoDB連線時發生錯誤: {e}")
+        
+        with STARTUP.phase("warm_up:feed"):
+            feed_cache.get()
+            feed_cache.start()
+    STARTUP.report()
+
+STARTUP.mark("import:app")
+
 if __name__ == "__main__":
     # 啟動時初始化圖文選單
     initialize_app()
+    if WARMUP_ON_START:
+        warm_up()
+    else:
+        # 預先啟動Feed背景更新
+        feed_cache.start()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,65 @@
+import threading
+from pymongo.errors import BulkWriteError
+
+
+class BatchWriter:
+    """緩衝文件並以 insert_many 批次寫入 MongoDB（執行緒安全）
+
+    累積到 batch_size 筆時自動寫入，其餘由 flush() 寫入；
+    使用 ordered=False，單筆失敗不會中斷同批其他文件的寫入。
+    可作為 context manager 使用，離開時自動 flush。
+    """
+
+    def __init__(self, collection, batch_size=500):
+        """
+        @param collection: 寫入的 MongoDB 集合
+        @param batch_size: 每批寫入的文件數量
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self.written = 0
+        self.failed = 0
+
+    def add(self, documents):
+        """加入要寫入的文件，緩衝區已滿時寫入一批
+
+        @param documents: 文件列表
+        """
+        with self._lock:
+            self._buffer.extend(documents)
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+        self._write(batch)
+
+    def flush(self):
+        """寫入緩衝區中剩餘的文件"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            result = self.collection.insert_many(batch, ordered=False)
+            written, failed = len(result.inserted_ids), 0
+        except BulkWriteError as e:
+            written = e.details.get('nInserted', 0)
+            failed = len(batch) - written
+            print(f"批次寫入時有 {failed} 筆失敗: {e.details.get('writeErrors', [])[:1]}")
+        except Exception as e:
+            written, failed = 0, len(batch)
+            print(f"批次寫入 {len(batch)} 筆時發生錯誤: {e}")
+
+        with self._lock:
+            self.written += written
+            self.failed += failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
@@ -0,0 +1,406 @@
+"""
+/callback webhook 離線壓力測試
+
+以測試用的 channel secret 簽署模擬的 LINE webhook 內容（類別搜尋、類別點選、
+偏好切換、postback），直接送進 Flask app。LINE Messaging API 與 MongoDB 以本機替身取代，
+華視新聞Feed由本機的測試伺服器提供，不會連到任何外部服務。
+
+使用方式：
+    python bench_webhook.py --concurrency 1 4 16 64 --requests 2000
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+# 測試用的 channel secret，只用於簽署與驗證本機產生的webhook
+TEST_CHANNEL_SECRET = "bench-channel-secret"
+
+CATEGORIES = [
+    "即時", "氣象", "政治", "MLB", "國際", "社會",
+    "運動", "生活", "財經", "地方", "產業", "綜合",
+    "藝文", "旅遊", "專題"
+]
+
+
+def build_feed_xml(article_count=600):
+    """產生測試用的 lineToday.xml"""
+    now_ms = int(time.time() * 1000)
+    articles = []
+    for i in range(article_count):
+        category = CATEGORIES[i % len(CATEGORIES)]
+        article_id = f"{time.strftime('%Y%m')}{i:06d}"
+        articles.append(
+            "<article>"
+            f"<ID>{article_id}</ID>"
+            f"<title><![CDATA[{category}測試新聞標題 {i}]]></title>"
+            f"<category>{category}</category>"
+            f"<publishTimeUnix>{now_ms - i * 60000}</publishTimeUnix>"
+            f"<updateTimeUnix>{now_ms - i * 60000}</updateTimeUnix>"
+            f"<thumbnail>https://example.com/thumb/{i}.jpg</thumbnail>"
+            f"<sourceUrl>https://news.cts.com.tw/cts/general/{article_id[:6]}/{article_id}.html</sourceUrl>"
+            "</article>"
+        )
+    return ('<?xml version="1.0" encoding="UTF-8"?><articles>'
+            + "".join(articles) + "</articles>").encode('utf-8')
+
+
+class FeedFixtureServer:
+    """提供固定Feed內容的本機HTTP伺服器，支援 ETag 條件式請求"""
+
+    def __init__(self, xml_bytes):
+        etag = '"%s"' % hashlib.md5(xml_bytes).hexdigest()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(xml_bytes)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(xml_bytes)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api/lineToday.xml"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+class FakeLineResponse:
+    """LINE API 替身的回應"""
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.headers = {}
+        self.json = {}
+
+
+class FakeLineHttpClient:
+    """取代 LineBotApi 的HTTP用戶端：保留SDK的訊息序列化，只模擬網路延遲"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.timeout = 5
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _respond(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeLineResponse()
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._respond()
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._respond()
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._respond()
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._respond()
+
+
+def evaluate(expr, doc, variables=None):
+    """計算管線更新中的聚合運算式，只支援 app 使用到的運算子"""
+    variables = variables or {}
+    if isinstance(expr, str) and expr.startswith('$$'):
+        return variables[expr[2:]]
+    if isinstance(expr, str) and expr.startswith('$'):
+        return doc.get(expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(item, doc, variables) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+
+    (operator, args), = expr.items()
+    if operator == '$filter':
+        return [item for item in evaluate(args["input"], doc, variables)
+                if evaluate(args["cond"], doc, {**variables, "this": item})]
+    values = evaluate(args, doc, variables)
+    if operator == '$ifNull':
+        return next((value for value in values if value is not None), None)
+    if operator == '$cond':
+        return values[1] if values[0] else values[2]
+    if operator == '$in':
+        return values[0] in values[1]
+    if operator == '$ne':
+        return values[0] != values[1]
+    if operator == '$concatArrays':
+        return [item for value in values for item in value]
+    raise ValueError(f"不支援的運算子: {operator}")
+
+
+class MemoryCollection:
+    """MongoDB users 集合的記憶體替身，只實作 app 使用到的操作"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.docs = {}
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _project(self, doc, projection):
+        if doc is None:
+            return None
+        if not projection:
+            return dict(doc)
+        return {key: list(value) if isinstance(value, list) else value
+                for key, value in doc.items() if projection.get(key)}
+
+    def find_one(self, filter, projection=None):
+        self._wait()
+        with self.lock:
+            return self._project(self.docs.get(filter["user_id"]), projection)
+
+    def update_one(self, filter, update, upsert=False):
+        self._wait()
+        with self.lock:
+            doc = self.docs.get(filter["user_id"])
+            if doc is None:
+                if not upsert:
+                    return
+                doc = self.docs[filter["user_id"]] = {"user_id": filter["user_id"]}
+            doc.update(update.get("$set", {}))
+
+    def find_one_and_update(self, filter, update, projection=None, upsert=False, return_document=None):
+        self._wait()
+        with self.lock:
+            doc = self.docs.get(filter["user_id"])
+            if doc is None:
+                if not upsert:
+                    return None
+                doc = self.docs[filter["user_id"]] = {"user_id": filter["user_id"]}
+
+            # app 以管線更新在伺服器端切換類別，依序執行各階段的 $set
+            for stage in update:
+                doc.update({field: evaluate(expr, doc) for field, expr in stage["$set"].items()})
+            return self._project(doc, projection)
+
+
+def sign(body, secret=TEST_CHANNEL_SECRET):
+    """計算 X-Line-Signature"""
+    digest = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def text_event(user_id, text):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": f"bench-{random.getrandbits(48):x}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"reply-{random.getrandbits(64):x}",
+        "message": {"id": str(random.getrandbits(40)), "type": "text", "text": text, "quoteToken": "q"}
+    }
+
+
+def postback_event(user_id, data):
+    return {
+        "type": "postback",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": f"bench-{random.getrandbits(48):x}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"reply-{random.getrandbits(64):x}",
+        "postback": {"data": data}
+    }
+
+
+def build_scenario(user_id, rng):
+    """產生一位使用者的一段操作（多個webhook），模擬實際使用情境"""
+    kind = rng.random()
+    category = rng.choice(CATEGORIES)
+    if kind < 0.5:
+        # 類別搜尋後點選類別
+        return [[text_event(user_id, "類別搜尋")], [text_event(user_id, category)]]
+    if kind < 0.75:
+        # 進入偏好設定後切換類別
+        return [[text_event(user_id, "偏好設定")], [text_event(user_id, category)]]
+    if kind < 0.9:
+        # 透過 postback 開啟詳細選單並切換類別
+        return [[postback_event(user_id, "set_preferences")], [postback_event(user_id, f"category_{category}")]]
+    return [[text_event(user_id, rng.choice(["幫助", "全選偏好", "清除偏好"]))]]
+
+
+def build_requests(count, users, events_per_request, seed):
+    """預先產生已簽署的webhook請求 (body, signature)"""
+    rng = random.Random(seed)
+    user_ids = [f"U{rng.getrandbits(128):032x}" for _ in range(users)]
+    requests_ = []
+    # 進行中的使用者操作；同一批webhook混合多位使用者的下一步，同一使用者的步驟依序出現
+    active = []
+    while len(requests_) < count:
+        while len(active) < events_per_request:
+            active.append(build_scenario(rng.choice(user_ids), rng))
+        events = []
+        for scenario in active[:events_per_request]:
+            events.extend(scenario.pop(0))
+        active = [scenario for scenario in active if scenario]
+        body = json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False)
+        requests_.append((body, sign(body)))
+    return requests_
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_level(flask_app, requests_, concurrency):
+    """以指定並行數送出所有請求，回傳統計結果"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    index = [0]
+
+    def worker():
+        client = flask_app.test_client()
+        local = []
+        local_errors = 0
+        while True:
+            with lock:
+                i = index[0]
+                index[0] += 1
+            if i >= len(requests_):
+                break
+            body, signature = requests_[i]
+            start = time.perf_counter()
+            response = client.post('/callback', data=body.encode('utf-8'), headers={
+                'X-Line-Signature': signature,
+                'Content-Type': 'application/json'
+            })
+            local.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def load_app(args, feed_url, workdir):
+    """在暫存目錄中以測試設定載入 app，並換上本機替身"""
+    env_lines = [
+        f"LINE_CHANNEL_SECRET={TEST_CHANNEL_SECRET}",
+        "LINE_CHANNEL_ACCESS_TOKEN=bench-access-token",
+        # MongoClient 不會在建立時連線；users 集合稍後換成記憶體替身
+        "MONGODB_URI=mongodb://127.0.0.1:9/?serverSelectionTimeoutMS=100",
+        "MONGODB_DB=bench",
+        f"WEBHOOK_ASYNC={'true' if args.async_mode else 'false'}",
+        f"WEBHOOK_WORKERS={args.workers}",
+        # LINE API 速率上限；預設放寬到不影響結果，測試限流時再調低
+        f"LINE_API_RATE={args.line_rate}",
+    ]
+    with open(os.path.join(workdir, ".env"), "w", encoding="utf-8") as f:
+        f.write("\n".join(env_lines) + "\n")
+
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as webhook_app
+
+    webhook_app.feed_fetcher.url = feed_url
+    webhook_app.users_collection = MemoryCollection(latency=args.mongo_latency_ms / 1000)
+    line_http = FakeLineHttpClient(latency=args.line_latency_ms / 1000)
+    webhook_app.line_bot_api.get().http_client = line_http
+    webhook_app.app.logger.disabled = True
+    return webhook_app, line_http
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/callback webhook 離線壓力測試')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help='依序測試的並行數')
+    parser.add_argument('--requests', type=int, default=2000, help='每個並行數送出的請求數')
+    parser.add_argument('--users', type=int, default=500, help='模擬的使用者數量')
+    parser.add_argument('--events-per-request', type=int, default=1, help='每個webhook包含的事件數')
+    parser.add_argument('--articles', type=int, default=600, help='測試Feed的新聞數量')
+    parser.add_argument('--line-latency-ms', type=float, default=0.0, help='模擬LINE API延遲（毫秒）')
+    parser.add_argument('--line-rate', type=float, default=1000000.0, help='LINE API 每秒請求上限 (LINE_API_RATE)')
+    parser.add_argument('--mongo-latency-ms', type=float, default=0.0, help='模擬MongoDB延遲（毫秒）')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='以非同步webhook模式測試')
+    parser.add_argument('--workers', type=int, default=4, help='非同步模式的工作執行緒數量')
+    parser.add_argument('--seed', type=int, default=42, help='產生請求的亂數種子')
+    parser.add_argument('--json', type=str, default=None, help='將結果另存為JSON檔案')
+    args = parser.parse_args()
+    if args.json:
+        # app 會在暫存目錄中執行，先轉為絕對路徑
+        args.json = os.path.abspath(args.json)
+
+    feed_server = FeedFixtureServer(build_feed_xml(args.articles))
+    workdir = tempfile.mkdtemp(prefix="bench_webhook_")
+    webhook_app, line_http = load_app(args, feed_server.url, workdir)
+
+    # 預熱：載入Feed並建立靜態選單
+    webhook_app.feed_cache.get()
+    run_level(webhook_app.app, build_requests(50, args.users, args.events_per_request, args.seed + 1), 1)
+
+    print(f"{'並行數':>6} {'請求數':>7} {'錯誤':>5} {'req/s':>9} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9}")
+    results = []
+    for concurrency in args.concurrency:
+        requests_ = build_requests(args.requests, args.users, args.events_per_request, args.seed + concurrency)
+        result = run_level(webhook_app.app, requests_, concurrency)
+        results.append(result)
+        print(f"{result['concurrency']:>9} {result['requests']:>10} {result['errors']:>7} {result['rps']:>9} "
+              f"{result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9}")
+
+    if webhook_app.event_dispatcher is not None:
+        webhook_app.event_dispatcher.shutdown()
+    print(f"LINE API 替身收到 {line_http.calls} 次呼叫")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果已保存至 {args.json}")
+
+    feed_server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def notifier_module():
+    """以其他名稱載入 schedule.py，避免與 schedule 套件同名衝突"""
+    spec = importlib.util.spec_from_file_location('notifier', os.path.join(ROOT, 'schedule.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
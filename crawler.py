@@ -1,4 +1,5 @@
 import requests
+import http_client
 import random
 import time
 import re
@@ -82,12 +83,11 @@ def fetch_news(category="即時", count=10):
         # 添加隨機延遲，避免頻繁請求
         time.sleep(random.uniform(1, 3))
         
-        # 發送請求時增加重試機制
-        session = requests.Session()
+        # 發送請求時增加重試機制（使用共用HTTP用戶端，重用連線）
         retries = 3
         for attempt in range(retries):
             try:
-                response = session.get(url, headers=headers, timeout=15)
+                response = http_client.get(url, headers=headers)
                 response.raise_for_status()
                 break
             except requests.exceptions.RequestException as e:
@@ -190,12 +190,11 @@ def extract_news_details(url):
     }
     
     try:
-        # 增加重試機制
-        session = requests.Session()
+        # 增加重試機制（使用共用HTTP用戶端，重用連線）
         retries = 3
         for attempt in range(retries):
             try:
-                response = session.get(url, headers=headers, timeout=15)
+                response = http_client.get(url, headers=headers)
                 response.encoding = 'utf-8'
                 response.raise_for_status()
                 break
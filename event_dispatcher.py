@@ -0,0 +1,186 @@
+import atexit
+import os
+import queue
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# 通知工作執行緒結束的標記
+_STOP = object()
+
+
+class EventDispatcher:
+    """以有界佇列與執行緒池在背景處理webhook事件
+
+    /callback 驗證簽章後把事件放入佇列即可回應，由工作執行緒以整批事件呼叫處理函式。
+    佇列已滿時 submit 會回傳 False，由呼叫端自行處理（背壓）。
+    """
+
+    def __init__(self, handle_func, workers=4, queue_size=100, put_timeout=1.0):
+        """
+        @param handle_func: 處理一批事件的函式（參數為事件列表）
+        @param workers: 工作執行緒數量
+        @param queue_size: 佇列最多可容納的webhook批次數量
+        @param put_timeout: 佇列已滿時最多等待的秒數
+        """
+        self.handle_func = handle_func
+        self.workers = workers
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._closed = False
+
+    def start(self):
+        """在目前行程啟動工作執行緒（fork後的子行程會各自重新啟動）"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._threads = [
+                threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = pid
+            self._closed = False
+
+        # 行程結束前先處理完佇列中的事件
+        atexit.register(self.shutdown)
+
+    def submit(self, events):
+        """將一批事件放入佇列
+
+        @param events: 事件列表
+        @return: 是否成功放入佇列；已關閉或佇列已滿時回傳False
+        """
+        self.start()
+        if self._closed:
+            return False
+
+        try:
+            self._queue.put(events, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            print(f"webhook佇列已滿 ({self.queue_size})，改由請求執行緒直接處理")
+            return False
+
+    def pending(self):
+        """佇列中等待處理的批次數量"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _worker(self):
+        """工作執行緒：從佇列取出事件並處理"""
+        while True:
+            events = self._queue.get()
+            try:
+                if events is _STOP:
+                    return
+                self.handle_func(events)
+            except Exception as e:
+                print(f"處理webhook事件時發生錯誤: {e}")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def shutdown(self, timeout=30):
+        """停止接收新事件，等待佇列中的事件處理完畢
+
+        @param timeout: 每個工作執行緒最多等待的秒數
+        """
+        with self._lock:
+            if self._pid != os.getpid() or self._closed:
+                return
+            self._closed = True
+
+        remaining = self.pending()
+        if remaining:
+            print(f"正在處理剩餘的 {remaining} 批webhook事件...")
+
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+class KeyedExecutor:
+    """以有界執行緒池並行執行工作，同一個 key 的工作依提交順序逐一執行
+
+    用於同時處理一批webhook事件：不同使用者的事件並行處理，
+    同一使用者的事件（例如連續切換偏好）仍維持先後順序，不會互相競爭。
+    """
+
+    def __init__(self, workers=8):
+        """
+        @param workers: 執行緒池的執行緒數量上限
+        """
+        self.workers = workers
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        # {key: 等待執行的工作}，key 存在表示已有執行緒負責依序執行
+        self._pending = {}
+
+    def _get_executor(self):
+        """目前行程的執行緒池（fork後的子行程會重新建立）"""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="keyed-worker")
+                    self._pending = {}
+                    self._pid = pid
+        return self._executor
+
+    def submit(self, key, fn, *args):
+        """提交工作
+
+        @param key: 排序用的key，None表示不需與其他工作排序
+        @param fn: 要執行的函式
+        @return: concurrent.futures.Future
+        """
+        executor = self._get_executor()
+        future = Future()
+        if key is None:
+            executor.submit(self._run, future, fn, args)
+            return future
+
+        with self._lock:
+            tasks = self._pending.get(key)
+            if tasks is not None:
+                # 同一個key已有工作在執行，排在後面由同一個執行緒接續處理
+                tasks.append((future, fn, args))
+                return future
+            self._pending[key] = deque([(future, fn, args)])
+        executor.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        """依序執行同一個key的工作，直到沒有等待中的工作"""
+        while True:
+            with self._lock:
+                tasks = self._pending[key]
+                if not tasks:
+                    del self._pending[key]
+                    return
+                future, fn, args = tasks.popleft()
+            self._run(future, fn, args)
+
+    @staticmethod
+    def _run(future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
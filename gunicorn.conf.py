@@ -0,0 +1,9 @@
+# gunicorn 設定：worker 載入應用（fork 之後）時輸出啟動耗時，並依 WARMUP_ON_START 預熱連線
+
+def post_worker_init(worker):
+    import app
+
+    if app.WARMUP_ON_START:
+        app.warm_up()
+    else:
+        app.STARTUP.report()
@@ -0,0 +1,138 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+
+class HTTPClient:
+    """共用的HTTP用戶端
+
+    所有對外請求共用同一個 Session：每個主機各自有連線池並保持連線（keep-alive），
+    並套用預設的連線／讀取逾時，避免上游沒有回應時卡住worker。
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=15, pool_connections=10, pool_maxsize=10):
+        """
+        @param connect_timeout: 建立連線的逾時秒數
+        @param read_timeout: 等待回應的逾時秒數
+        @param pool_connections: 最多保留連線池的主機數量
+        @param pool_maxsize: 每個主機連線池最多保留的連線數量
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        """目前行程的 Session（fork後的子行程會重新建立，不共用socket）"""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=self.pool_connections,
+                        pool_maxsize=self.pool_maxsize
+                    )
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._pid = pid
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """送出請求，未指定 timeout 時使用預設逾時"""
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def stats(self):
+        """各主機連線池的使用統計
+
+        @return: {主機: {"requests": 請求數, "hits": 重用連線數, "misses": 新建連線數}}
+        """
+        result = {}
+        if self._session is None or self._pid != os.getpid():
+            return result
+
+        adapter = self._session.get_adapter('https://')
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}:{pool.port}"
+            stats = result.setdefault(host, {"requests": 0, "hits": 0, "misses": 0})
+            stats["requests"] += pool.num_requests
+            stats["misses"] += pool.num_connections
+            stats["hits"] += max(0, pool.num_requests - pool.num_connections)
+        return result
+
+
+# 行程內共用的HTTP用戶端
+default_client = HTTPClient()
+
+
+def configure(connect_timeout=None, read_timeout=None, pool_connections=None, pool_maxsize=None):
+    """調整共用HTTP用戶端的設定（需在第一次送出請求前呼叫）"""
+    connect, read = default_client.timeout
+    default_client.timeout = (
+        connect if connect_timeout is None else connect_timeout,
+        read if read_timeout is None else read_timeout
+    )
+    if pool_connections is not None:
+        default_client.pool_connections = pool_connections
+    if pool_maxsize is not None:
+        default_client.pool_maxsize = pool_maxsize
+
+
+def get(url, **kwargs):
+    """以共用HTTP用戶端送出GET請求"""
+    return default_client.get(url, **kwargs)
+
+
+def pool_stats():
+    """共用HTTP用戶端的連線池統計"""
+    return default_client.stats()
+
+
+class PooledLineHttpClient(RequestsHttpClient):
+    """讓 LineBotApi 透過共用HTTP用戶端送出請求，重用與LINE伺服器的連線
+
+    使用方式：LineBotApi(token, http_client=PooledLineHttpClient)
+    """
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = default_client.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = default_client.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = default_client.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = default_client.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """記錄啟動各階段的耗時
+
+    mark() 記錄距離上一次標記經過的時間，適合量測模組載入的各段落；
+    phase() 則量測單一區塊（例如建立連線、預熱）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._last_mark = time.perf_counter()
+
+    def record(self, phase, seconds):
+        """記錄一個階段的耗時（同一階段以最後一次為準）"""
+        with self._lock:
+            self._phases[phase] = seconds
+
+    def mark(self, phase):
+        """記錄距離上一次標記經過的時間"""
+        now = time.perf_counter()
+        with self._lock:
+            seconds = now - self._last_mark
+            self._last_mark = now
+        self.record(phase, seconds)
+
+    @contextmanager
+    def phase(self, phase):
+        """計時區塊的執行時間（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def snapshot(self):
+        """{(("phase", 階段),): 秒數}，供 metrics.Gauge 使用"""
+        with self._lock:
+            return {(("phase", phase),): round(seconds, 6) for phase, seconds in self._phases.items()}
+
+    def report(self):
+        """印出各階段耗時"""
+        with self._lock:
+            phases = list(self._phases.items())
+        details = ", ".join(f"{phase}={seconds * 1000:.1f}ms" for phase, seconds in phases)
+        print(f"啟動耗時 (pid {os.getpid()}): {details}")
+
+
+# 行程內共用的啟動計時器
+STARTUP = StartupTimer()
+
+
+class ProcessLocal:
+    """延遲建立、每個行程各自一份的物件
+
+    第一次使用時才呼叫 factory 建立物件；fork後的子行程會重新建立，
+    不會沿用父行程的socket或背景執行緒。屬性存取會轉給實際物件，
+    因此可以直接當作原本的物件使用（例如 users_collection.find_one(...)）。
+    """
+
+    def __init__(self, name, factory, timer=None):
+        """
+        @param name: 名稱，用於啟動耗時報告
+        @param factory: 建立物件的函式
+        @param timer: 記錄建立耗時的 StartupTimer，None表示不記錄
+        """
+        self._name = name
+        self._factory = factory
+        self._timer = timer
+
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+
+    def get(self):
+        """取得目前行程的物件，尚未建立時才建立"""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    start = time.perf_counter()
+                    self._value = self._factory()
+                    self._pid = pid
+                    if self._timer is not None:
+                        self._timer.record(f"init:{self._name}", time.perf_counter() - start)
+        return self._value
+
+    def set(self, value):
+        """直接指定目前行程使用的物件（例如換成測試替身）"""
+        with self._lock:
+            self._value = value
+            self._pid = os.getpid()
+
+    def initialized(self):
+        """目前行程是否已建立物件"""
+        return self._pid == os.getpid()
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
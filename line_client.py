@@ -0,0 +1,150 @@
+import random
+import threading
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from metrics import REGISTRY
+
+# 每次LINE API呼叫的耗時與結果，由 /metrics 輸出
+LINE_API_SECONDS = REGISTRY.summary('line_api_seconds', 'LINE API 呼叫耗時（秒，包含重試與等待）')
+LINE_API_CALLS = REGISTRY.counter('line_api_calls_total', '依方法與結果統計的LINE API呼叫數')
+LINE_API_RETRIES = REGISTRY.counter('line_api_retries_total', '依方法與狀態碼統計的LINE API重試次數')
+
+# 可重試的狀態碼：429 為超過速率限制，5xx 為LINE伺服器暫時錯誤
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """令牌桶速率限制器（執行緒安全）"""
+
+    def __init__(self, rate, capacity=None):
+        """
+        @param rate: 每秒補充的令牌數（即平均每秒最多請求數）
+        @param capacity: 令牌桶容量（允許的瞬間請求數），預設與 rate 相同；至少為1，
+                         否則每秒少於1次的速率永遠存不到一個令牌
+        """
+        if rate <= 0:
+            raise ValueError(f"rate 必須大於0: {rate}")
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity or rate))
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def acquire(self, tokens=1):
+        """取得令牌，不足時等待
+
+        @return: 等待的秒數
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def retry_after_seconds(error):
+    """從 Retry-After 標頭取得等待秒數，沒有或無法解析時回傳None"""
+    headers = getattr(error, 'headers', None) or {}
+    value = next((v for k, v in headers.items() if k.lower() == 'retry-after'), None)
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedLineBotApi(LineBotApi):
+    """具速率限制與自動重試的 LineBotApi
+
+    reply_message、push_message、multicast、broadcast 送出前會先向令牌桶取得額度，
+    遇到 429 或 5xx 時依 Retry-After 或指數退避（含隨機抖動）重試，
+    並記錄每個方法的耗時與結果。push 類請求會帶上同一個 retry key，
+    重試時LINE不會重複送出已接受的訊息。
+    """
+
+    def __init__(self, channel_access_token, rate=None, burst=None, max_retries=3,
+                 backoff_base=0.5, backoff_max=30.0, **kwargs):
+        """
+        @param channel_access_token: 頻道存取權杖
+        @param rate: 每秒最多請求數，None表示不限制
+        @param burst: 允許的瞬間請求數，預設與 rate 相同
+        @param max_retries: 最多重試次數
+        @param backoff_base: 第一次重試前的等待秒數，之後每次加倍
+        @param backoff_max: 單次等待的最長秒數
+        @param kwargs: 傳給 LineBotApi 的其他參數（例如 http_client）
+        """
+        super().__init__(channel_access_token, **kwargs)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _backoff(self, attempt, error):
+        """計算第 attempt 次重試前的等待秒數"""
+        delay = retry_after_seconds(error)
+        if delay is None:
+            # 全抖動（full jitter）：避免多個worker同時重試
+            delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+        return min(delay, self.backoff_max)
+
+    def _call(self, method, func, *args, **kwargs):
+        """以速率限制與重試呼叫 LINE API"""
+        start = time.perf_counter()
+        attempt = 0
+        try:
+            while True:
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                try:
+                    result = func(*args, **kwargs)
+                    LINE_API_CALLS.inc(method=method, outcome="ok")
+                    return result
+                except LineBotApiError as e:
+                    if e.status_code == 409 and kwargs.get('retry_key') and e.accepted_request_id:
+                        # 同一個 retry key 的請求先前已被接受，視為成功
+                        LINE_API_CALLS.inc(method=method, outcome="ok")
+                        return None
+                    if e.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                        LINE_API_CALLS.inc(method=method, outcome=str(e.status_code))
+                        raise
+                    LINE_API_RETRIES.inc(method=method, status=e.status_code)
+                    delay = self._backoff(attempt, e)
+                    print(f"LINE API {method} 回應 {e.status_code}，{delay:.1f} 秒後重試")
+                    time.sleep(delay)
+                    attempt += 1
+                except Exception:
+                    LINE_API_CALLS.inc(method=method, outcome="error")
+                    raise
+        finally:
+            LINE_API_SECONDS.observe(time.perf_counter() - start, method=method)
+
+    def reply_message(self, reply_token, messages, *args, **kwargs):
+        return self._call('reply_message', super().reply_message, reply_token, messages, *args, **kwargs)
+
+    def push_message(self, to, messages, retry_key=None, **kwargs):
+        return self._call('push_message', super().push_message, to, messages,
+                          retry_key=retry_key or str(uuid.uuid4()), **kwargs)
+
+    def multicast(self, to, messages, retry_key=None, **kwargs):
+        return self._call('multicast', super().multicast, to, messages,
+                          retry_key=retry_key or str(uuid.uuid4()), **kwargs)
+
+    def broadcast(self, messages, retry_key=None, **kwargs):
+        return self._call('broadcast', super().broadcast, messages,
+                          retry_key=retry_key or str(uuid.uuid4()), **kwargs)
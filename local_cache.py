@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """行程內的LRU快取，每筆資料有存活時間，超過容量時淘汰最久未使用的資料"""
+
+    def __init__(self, max_size=10000, ttl=60):
+        """
+        @param max_size: 最多保存的資料筆數
+        @param ttl: 每筆資料的存活秒數
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """取得資料，不存在或已過期時回傳 default"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """寫入資料並更新存活時間"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """刪除資料"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """清空所有資料"""
+        with self._lock:
+            self._data.clear()
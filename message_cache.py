@@ -0,0 +1,56 @@
+import threading
+from linebot.models import SendMessage
+
+
+class PrebuiltMessage(SendMessage):
+    """內容已預先轉為JSON字典的訊息
+
+    LineBotApi 送出訊息時只會呼叫 as_json_dict()，直接回傳建好的字典，
+    不必每次重新建立與走訪 Flex 物件樹。內容可在多次回覆間共用，請勿修改。
+    """
+
+    def __init__(self, json_dict):
+        """
+        @param json_dict: Messaging API 格式的訊息字典
+        """
+        self.json_dict = json_dict
+
+    def as_json_dict(self):
+        return self.json_dict
+
+
+class VersionedMessageCache:
+    """依Feed版本失效的訊息快取
+
+    同一個Feed版本下，相同鍵值（例如類別）的訊息內容對所有使用者都相同；
+    Feed版本改變時清空所有快取。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._messages = {}
+
+    def get(self, version, key, build):
+        """取得快取的訊息，不存在時呼叫 build() 建立
+
+        @param version: 目前的Feed版本
+        @param key: 快取鍵值
+        @param build: 建立訊息的函式，回傳None表示不快取
+        @return: 訊息物件或None
+        """
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._messages = {}
+            message = self._messages.get(key)
+
+        if message is not None:
+            return message
+
+        message = build()
+        if message is not None:
+            with self._lock:
+                if version == self._version:
+                    self._messages[key] = message
+        return message
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 摘要輸出的分位數
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _format_labels(labels):
+    """將標籤轉為 Prometheus 文字格式"""
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Summary:
+    """耗時摘要：以最近的觀測值計算分位數，並累計總和與次數"""
+
+    def __init__(self, name, help_text, window=1024):
+        """
+        @param name: 指標名稱
+        @param help_text: 指標說明
+        @param window: 計算分位數時保留的最近觀測值數量
+        """
+        self.name = name
+        self.help_text = help_text
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        """記錄一筆觀測值"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [deque(maxlen=self.window), 0.0, 0]
+            series[0].append(value)
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """計時區塊的執行時間（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} summary"]
+        with self._lock:
+            snapshot = [(key, sorted(values), total, count) for key, (values, total, count) in self._series.items()]
+
+        for key, values, total, count in sorted(snapshot):
+            for q in QUANTILES:
+                value = values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+                lines.append(f"{self.name}{_format_labels(key + (('quantile', q),))} {value:.6f}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Counter:
+    """只增不減的計數器"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """增加計數"""
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        for key, value in snapshot:
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """輸出時才呼叫函式取值的量測值
+
+    函式回傳數值，或 {標籤字典的tuple: 數值}；回傳None表示目前沒有資料。
+    """
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.func()
+        except Exception as e:
+            print(f"讀取指標 {self.name} 時發生錯誤: {e}")
+            value = None
+
+        if isinstance(value, dict):
+            for key, item in sorted(value.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {item}")
+        elif value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    """指標登錄表（每個行程各自一份）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def summary(self, name, help_text, window=1024):
+        return self._get_or_create(name, lambda: Summary(name, help_text, window))
+
+    def counter(self, name, help_text):
+        return self._get_or_create(name, lambda: Counter(name, help_text))
+
+    def gauge(self, name, help_text, func):
+        return self._get_or_create(name, lambda: Gauge(name, help_text, func))
+
+    def render(self):
+        """以 Prometheus 文字格式輸出所有指標"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+# 行程內共用的指標登錄表
+REGISTRY = Registry()
+
+# Prometheus 文字格式的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
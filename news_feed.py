@@ -0,0 +1,448 @@
+import datetime
+import itertools
+import os
+import threading
+import time
+import traceback
+import xml.etree.ElementTree as ET
+import http_client
+
+# 華視新聞XML RSS網址
+FEED_URL = "https://news.cts.com.tw/api/lineToday.xml"
+
+# 每次建立索引時遞增的Feed版本號
+_feed_versions = itertools.count(1)
+
+# 串流解析時每次送入解析器的資料大小
+CHUNK_SIZE = 64 * 1024
+
+
+def _iter_chunks(source):
+    """將XML文字／位元組或逐段資料統一為逐段資料"""
+    if isinstance(source, (str, bytes)):
+        for start in range(0, len(source), CHUNK_SIZE):
+            yield source[start:start + CHUNK_SIZE]
+    else:
+        yield from source
+
+
+def iter_article_elements(source, tag='article'):
+    """以串流方式逐篇解析Feed中的 <article> 元素
+
+    每篇文章解析完成即回傳，處理完後清除並從父元素移除，記憶體用量不隨Feed大小成長。
+    呼叫端需在取下一篇之前讀完目前元素的內容；中途停止迭代則不再讀取剩餘資料。
+
+    @param source: XML文字／位元組，或逐段的位元組序列（例如 response.iter_content()）
+    @param tag: 文章元素的標籤名稱（可位於任意深度）
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    stack = []
+
+    def handle_events():
+        for event, elem in parser.read_events():
+            if event == 'start':
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if elem.tag == tag:
+                yield elem
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+
+    for chunk in _iter_chunks(source):
+        if chunk:
+            parser.feed(chunk)
+            yield from handle_events()
+
+    parser.close()
+    yield from handle_events()
+
+
+# 類別對應的網址路徑，Feed未提供 sourceUrl 時用來組合新聞連結
+CATEGORY_PATHS = {
+    "即時": "real", "氣象": "weather", "政治": "politics", "MLB": "mlb",
+    "國際": "international", "社會": "society", "運動": "sports", "生活": "life",
+    "財經": "money", "台語": "taiwanese", "地方": "local", "產業": "industry",
+    "綜合": "general", "藝文": "arts", "旅遊": "travel", "專題": "subject"
+}
+
+
+def format_unix_ms(unix_time_ms, fmt='%Y-%m-%d %H:%M:%S'):
+    """將毫秒級Unix時間戳轉為可讀格式，無效時回傳空字串"""
+    if not unix_time_ms:
+        return ""
+    try:
+        return datetime.datetime.fromtimestamp(unix_time_ms / 1000).strftime(fmt)
+    except (OverflowError, OSError, ValueError):
+        return ""
+
+
+class Article:
+    """Feed中的單篇新聞
+
+    使用 __slots__ 儲存欄位，不為每篇新聞配置字典，保留多份Feed快照時較省記憶體。
+    """
+
+    __slots__ = ('id', 'title', 'category', 'publish_time_unix', 'update_time_unix', 'thumbnail', 'link')
+
+    def __init__(self, id, title, category, publish_time_unix=0, update_time_unix=0, thumbnail="", link=""):
+        """
+        @param id: 新聞ID
+        @param title: 標題
+        @param category: 類別
+        @param publish_time_unix: 發布時間（毫秒級Unix時間戳）
+        @param update_time_unix: 更新時間（毫秒級Unix時間戳）
+        @param thumbnail: 縮圖網址
+        @param link: 新聞網址
+        """
+        self.id = id
+        self.title = title
+        self.category = category
+        self.publish_time_unix = publish_time_unix
+        self.update_time_unix = update_time_unix
+        self.thumbnail = thumbnail
+        self.link = link
+
+    @property
+    def publish_time(self):
+        """可讀的發布時間"""
+        return format_unix_ms(self.publish_time_unix)
+
+    @property
+    def update_time(self):
+        """可讀的更新時間"""
+        return format_unix_ms(self.update_time_unix)
+
+    def to_dict(self):
+        """轉為字典（輸出JSON或除錯用）"""
+        return {
+            'id': self.id,
+            'title': self.title,
+            'category': self.category,
+            'publish_time': self.publish_time,
+            'update_time': self.update_time,
+            'thumbnail': self.thumbnail,
+            'link': self.link,
+        }
+
+    def __repr__(self):
+        return f"Article(id={self.id!r}, category={self.category!r}, title={self.title!r})"
+
+
+def _element_text(parent, tag_name):
+    """安全地獲取子元素文本"""
+    elem = parent.find(tag_name)
+    if elem is not None and elem.text:
+        return elem.text.strip()
+    return ""
+
+
+def _element_int(parent, tag_name):
+    """獲取子元素的整數值，無效時回傳0"""
+    try:
+        return int(_element_text(parent, tag_name) or 0)
+    except ValueError:
+        return 0
+
+
+def parse_article(elem):
+    """將單篇 <article> 元素轉為 Article"""
+    article_id = _element_text(elem, 'ID')
+    category = _element_text(elem, 'category')
+
+    # 標題可能在CDATA中；部分內容會殘留未被解析的CDATA標記
+    title = _element_text(elem, 'title')
+    if '![CDATA[' in title:
+        title = title.replace('![CDATA[', '').replace(']]>', '').strip()
+
+    # 優先使用Feed提供的網址，否則依類別組合
+    link = _element_text(elem, 'sourceUrl')
+    if not link and article_id:
+        path = CATEGORY_PATHS.get(category, "general")
+        link = f"https://news.cts.com.tw/cts/{path}/{article_id[:6]}/{article_id}.html"
+
+    return Article(
+        id=article_id,
+        title=title or "無標題",
+        category=category,
+        publish_time_unix=_element_int(elem, 'publishTimeUnix'),
+        update_time_unix=_element_int(elem, 'updateTimeUnix'),
+        thumbnail=_element_text(elem, 'thumbnail'),
+        link=link
+    )
+
+
+def parse_feed(source, limit=None):
+    """串流解析Feed為 Article 列表，取得足夠數量後立即停止；app 與推播排程共用
+
+    @param source: XML文字／位元組，或逐段的位元組序列
+    @param limit: 最多取得的新聞數量，None 表示全部
+    @return: Article 列表
+    """
+    articles = []
+    if limit is not None and limit <= 0:
+        return articles
+
+    for elem in iter_article_elements(source):
+        articles.append(parse_article(elem))
+        if limit is not None and len(articles) >= limit:
+            break
+    return articles
+
+
+class FeedFetcher:
+    """帶條件式請求（ETag / If-Modified-Since）的Feed下載器
+
+    記住上一次回應的驗證資訊，Feed未更新（HTTP 304）時只傳輸標頭，
+    並直接沿用上一次的解析結果，不必重新解析。驗證資訊只在解析成功且有結果時才保存，
+    下載中斷或解析失敗時，下一次請求不帶條件標頭，重新下載完整內容。
+    多個執行緒同時下載時會依序進行，避免驗證資訊與解析結果互相覆蓋。
+    """
+
+    def __init__(self, parser, url=FEED_URL, headers=None, timeout=None):
+        """
+        @param parser: 解析函式，輸入XML文字或逐段的位元組序列，回傳解析結果
+        @param url: Feed網址
+        @param headers: 額外的請求標頭
+        @param timeout: 請求逾時秒數，None 表示使用共用HTTP用戶端的預設逾時
+        """
+        self.parser = parser
+        self.url = url
+        self.headers = headers or {}
+        self.timeout = timeout
+
+        self.etag = None
+        self.last_modified = None
+        self._parsed = None
+        self._lock = threading.Lock()
+
+    def _request(self, stream=False):
+        """送出帶有驗證資訊的條件式請求"""
+        headers = dict(self.headers)
+        if self._parsed is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        response = http_client.get(self.url, headers=headers, timeout=self.timeout, stream=stream)
+
+        if response.status_code == 200:
+            # 內容已更新，上一次的解析結果不再適用
+            self._parsed = None
+        elif response.status_code != 304:
+            print(f"獲取RSS失敗: {response.status_code}")
+        return response
+
+    def _save(self, response, parsed):
+        """解析成功後保存結果與驗證資訊；沒有結果時不保存，下一次重新下載"""
+        if not parsed:
+            self._parsed = None
+            return
+        self._parsed = parsed
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+    def fetch(self):
+        """以串流方式下載並解析Feed
+
+        解析函式收到的是逐段的位元組序列，可邊下載邊解析。
+        下載中斷或解析失敗時，解析函式的例外會直接拋出，不保存驗證資訊。
+
+        @return: 解析結果；Feed未更新時沿用上一次的結果，失敗時回傳None
+        """
+        with self._lock:
+            response = self._request(stream=True)
+            try:
+                if response.status_code == 304:
+                    return self._parsed
+                if response.status_code != 200:
+                    return None
+
+                parsed = self.parser(response.iter_content(chunk_size=CHUNK_SIZE))
+                self._save(response, parsed)
+                return parsed
+            finally:
+                response.close()
+
+
+class FeedCache:
+    """行程內共用的Feed快取
+
+    在TTL內直接回傳快取內容；過期時同時發生的多個請求只會觸發一次下載
+    (single-flight)，其餘請求等待該次下載完成後共用結果。
+
+    已有快取時採用 stale-while-revalidate：過期或更新失敗時立即回傳上一次成功的
+    內容，並在背景重新載入。設定 refresh_interval 時另有背景執行緒定期更新，
+    讓快取保持在有效期內。
+    """
+
+    def __init__(self, loader, ttl=60, refresh_interval=None, retry_interval=10):
+        """
+        @param loader: 無參數的載入函式，回傳解析後的Feed內容，失敗時回傳None
+        @param ttl: 快取有效秒數
+        @param refresh_interval: 背景更新間隔秒數，None 表示不啟用背景更新
+        @param retry_interval: 載入失敗後，再次嘗試前至少等待的秒數
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded_at = 0.0
+        self._next_attempt = 0.0
+        self._inflight = None
+        self._last_error = None
+        self._refresher_pid = None
+
+    def get(self):
+        """取得Feed內容，必要時重新載入"""
+        self.start()
+
+        with self._lock:
+            value = self._value
+            if value is not None:
+                now = time.monotonic()
+                if (now - self._loaded_at >= self.ttl and self._inflight is None
+                        and now >= self._next_attempt):
+                    # 已過期：立即回傳舊資料，並在背景重新載入
+                    inflight = self._inflight = threading.Event()
+                    threading.Thread(target=self._load, args=(inflight,), daemon=True).start()
+                return value
+
+        # 尚無任何快取，只能等待載入完成
+        return self.refresh()
+
+    def refresh(self):
+        """立即重新載入Feed；若已有載入進行中則等待其結果
+
+        @return: 最新的Feed內容，載入失敗時回傳上一次成功的內容
+        """
+        with self._lock:
+            inflight = self._inflight
+            if inflight is None:
+                # 由目前的請求負責載入
+                inflight = self._inflight = threading.Event()
+                is_leader = True
+            else:
+                is_leader = False
+
+        if is_leader:
+            self._load(inflight)
+        else:
+            # 等待進行中的載入完成，再回傳結果（載入失敗時回傳舊的快取）
+            inflight.wait()
+
+        with self._lock:
+            return self._value
+
+    def _load(self, inflight):
+        """執行載入函式並更新快取"""
+        error = None
+        try:
+            value = self.loader()
+        except Exception as e:
+            print(f"載入Feed時發生錯誤: {e}")
+            traceback.print_exc()
+            value = None
+            error = str(e)
+
+        with self._lock:
+            now = time.monotonic()
+            if value is not None:
+                self._value = value
+                self._loaded_at = now
+                self._last_error = None
+                self._next_attempt = 0.0
+            else:
+                # 載入失敗時，至少等待 retry_interval 秒後才再次嘗試
+                self._last_error = error or "載入失敗"
+                self._next_attempt = now + self.retry_interval
+            self._inflight = None
+        inflight.set()
+
+    def start(self):
+        """在目前行程啟動背景更新執行緒（fork後的子行程會各自重新啟動）"""
+        pid = os.getpid()
+        if not self.refresh_interval or self._refresher_pid == pid:
+            return
+
+        with self._lock:
+            if self._refresher_pid == pid:
+                return
+            if self._refresher_pid is not None:
+                # fork前進行中的載入不會在子行程完成
+                self._inflight = None
+            self._refresher_pid = pid
+
+        threading.Thread(target=self._refresh_loop, name="feed-refresher", daemon=True).start()
+
+    def _refresh_loop(self):
+        """背景定期更新Feed"""
+        while True:
+            self.refresh()
+            time.sleep(self.refresh_interval)
+
+    def age(self):
+        """目前快取內容的存在秒數，尚無快取時回傳None"""
+        with self._lock:
+            if self._value is None:
+                return None
+            return time.monotonic() - self._loaded_at
+
+    def status(self):
+        """快取狀態摘要"""
+        age = self.age()
+        with self._lock:
+            return {
+                "age_seconds": round(age, 3) if age is not None else None,
+                "ttl": self.ttl,
+                "refresh_interval": self.refresh_interval,
+                "refreshing": self._inflight is not None,
+                "last_error": self._last_error,
+            }
+
+
+class FeedIndex:
+    """已解析Feed的索引
+
+    一次建立「類別 → 依發布時間由新到舊排序的新聞列表」以及「ID → 新聞」的對照，
+    查詢時不必再逐篇掃描整份Feed。每個索引有唯一的 version，可作為衍生快取的鍵值。
+    """
+
+    def __init__(self, articles):
+        """
+        @param articles: Article 列表（維持Feed原順序）
+        """
+        self.version = next(_feed_versions)
+        self.articles = articles
+        self.by_id = {}
+        self.by_category = {}
+
+        for article in articles:
+            if article.id:
+                self.by_id[article.id] = article
+            self.by_category.setdefault(article.category, []).append(article)
+
+        # 各類別依發布時間由新到舊排序（時間相同時維持Feed原順序）
+        for items in self.by_category.values():
+            items.sort(key=lambda item: item.publish_time_unix, reverse=True)
+
+    def __len__(self):
+        return len(self.articles)
+
+    def get(self, article_id):
+        """依ID取得新聞"""
+        return self.by_id.get(article_id)
+
+    def latest(self, category, count=10):
+        """取得指定類別最新的 count 則新聞"""
+        return self.by_category.get(category, [])[:count]
+
+    def iter_category(self, category):
+        """依發布時間由新到舊逐一取得指定類別的新聞"""
+        return iter(self.by_category.get(category, ()))
@@ -0,0 +1,90 @@
+import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+
+class PushCheckpoint:
+    """每日推送的執行進度（存放於 MongoDB）
+
+    push_runs 記錄每次執行的狀態與統計，push_run_users 記錄該次執行中已推送成功的用戶。
+    推送程式中斷後以相同的 run_id 重新執行時，會略過已完成的用戶並重試其餘用戶；
+    所有用戶都推送成功的執行才標記為已完成，已完成的執行不會再次推送。
+    """
+
+    def __init__(self, db, retention_days=7):
+        """
+        @param db: MongoDB 資料庫
+        @param retention_days: 已完成用戶紀錄的保留天數
+        """
+        self.runs = db.push_runs
+        self.run_users = db.push_run_users
+
+        self.run_users.create_index([("run_id", 1), ("user_id", 1)], unique=True)
+        self.run_users.create_index([("completed_at", 1)], expireAfterSeconds=int(retention_days * 86400))
+
+    def start(self, run_id):
+        """開始（或接續）一次執行
+
+        @param run_id: 執行ID，例如推送日期
+        @return: 執行紀錄；該次執行已完成時回傳None
+        """
+        now = datetime.datetime.now()
+        run = self.runs.find_one_and_update(
+            {"_id": run_id},
+            {
+                "$setOnInsert": {"started_at": now, "status": "running"},
+                "$set": {"updated_at": now},
+                "$inc": {"attempts": 1}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if run.get("status") == "completed":
+            return None
+        return run
+
+    def is_unfinished(self, run_id):
+        """該次執行是否已開始但尚未完成（中斷或有用戶推送失敗）"""
+        run = self.runs.find_one({"_id": run_id}, {"status": 1})
+        return run is not None and run.get("status") != "completed"
+
+    def completed_users(self, run_id, user_ids):
+        """查詢指定用戶中已在此次執行完成推送的用戶
+
+        @return: 已完成的用戶ID集合
+        """
+        cursor = self.run_users.find(
+            {"run_id": run_id, "user_id": {"$in": list(user_ids)}},
+            {"user_id": 1, "_id": 0}
+        )
+        return {item["user_id"] for item in cursor}
+
+    def mark_completed(self, run_id, user_ids):
+        """記錄已完成推送的用戶（重複記錄會被忽略）"""
+        now = datetime.datetime.now()
+        try:
+            self.run_users.insert_many(
+                [{"run_id": run_id, "user_id": user_id, "completed_at": now} for user_id in user_ids],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            # 只忽略重複鍵錯誤
+            errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != 11000]
+            if errors:
+                raise
+
+    def finish(self, run_id, stats):
+        """保存統計；沒有用戶推送失敗時標記執行完成，否則保留為未完成，重新執行時重試失敗的用戶
+
+        @return: 是否已標記為完成
+        """
+        completed = not stats.get("failed")
+        self.runs.update_one(
+            {"_id": run_id},
+            {"$set": {
+                "status": "completed" if completed else "partial",
+                "finished_at": datetime.datetime.now(),
+                "stats": stats
+            }}
+        )
+        return completed
@@ -1,17 +1,41 @@
-import xml.etree.ElementTree as ET
-import requests
 import datetime
 import time
 import schedule
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from dotenv import dotenv_values
-from linebot import LineBotApi
 from linebot.models import TextSendMessage, FlexSendMessage, BubbleContainer, BoxComponent, TextComponent, ImageComponent, ButtonComponent, URIAction
 from linebot.exceptions import LineBotApiError
+from news_feed import FeedFetcher, FeedIndex, parse_feed
+import http_client
+from http_client import PooledLineHttpClient
+from line_client import RateLimitedLineBotApi, TokenBucket
+from batch_writer import BatchWriter
+from push_checkpoint import PushCheckpoint
+
+# LINE multicast 每次最多的收件人數
+MULTICAST_LIMIT = 500
+# LINE push / multicast 每次請求最多的訊息數
+MAX_MESSAGES_PER_REQUEST = 5
+
+# 每日推送的問候訊息
+GREETING_TEXT = "早安！以下是今天的重點新聞："
+
+def pack_messages(messages, limit=MAX_MESSAGES_PER_REQUEST):
+    """將要給同一收件人的訊息打包成最少的請求，每個請求最多 limit 則訊息
+    
+    @param messages: 訊息列表（依送達順序）
+    @return: 每個請求的訊息列表
+    """
+    return [messages[i:i + limit] for i in range(0, len(messages), limit)]
 
 class CTSNewsLineNotifier:
-    def __init__(self, xml_url, mongo_uri=None, mongo_db=None, line_bot_api=None):
+    def __init__(self, xml_url, mongo_uri=None, mongo_db=None, line_bot_api=None, push_workers=8, push_rate=None,
+                 history_retention_days=30, history_batch_size=500, push_page_size=5000):
         """
         初始化華視新聞LINE通知系統
         
@@ -19,18 +43,38 @@ class CTSNewsLineNotifier:
         @param mongo_uri: MongoDB連接URI
         @param mongo_db: MongoDB資料庫名稱
         @param line_bot_api: 已初始化的LineBotApi實例
+        @param push_workers: 每日推送時同時處理的用戶數量
+        @param push_rate: 每日推送時每秒最多送出的推送批次數（push 或 multicast），None表示不限制
+        @param history_retention_days: 推送歷史保留天數，None表示永久保留
+        @param history_batch_size: 每日推送時每批寫入的推送歷史筆數
+        @param push_page_size: 每日推送時每次從資料庫讀取的用戶數量
         """
         self.xml_url = xml_url
         self.mongo_uri = mongo_uri
         self.mongo_db_name = mongo_db
+        self.push_workers = push_workers
+        self.push_limiter = TokenBucket(push_rate) if push_rate else None
+        self.history_retention_days = history_retention_days
+        self.history_batch_size = history_batch_size
+        self.push_page_size = push_page_size
         
         # 初始化數據庫和LINE設定
         self.mongo_client = None
         self.db = None
         self.user_collection = None
         self.push_history_collection = None
+        self.push_checkpoint = None
         self.line_bot_api = line_bot_api
         
+        # 以條件式請求下載XML，Feed未更新時沿用上一次的解析結果
+        self.feed_fetcher = FeedFetcher(
+            self.parse_xml,
+            xml_url,
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+            }
+        )
+        
         # 設置數據庫連接
         self.setup_database()
         
@@ -54,6 +98,15 @@ class CTSNewsLineNotifier:
             # 創建索引
             self.user_collection.create_index([("user_id", 1)], unique=True)
             self.push_history_collection.create_index([("user_id", 1), ("news_id", 1)])
+            try:
+                # 移除舊版建立的 (news_id, user_id) 索引，查詢已由上面的索引涵蓋
+                self.push_history_collection.drop_index("news_id_1_user_id_1")
+            except OperationFailure:
+                pass
+            self.setup_history_retention()
+            
+            # 每日推送的執行進度，推送中斷後可接續執行
+            self.push_checkpoint = PushCheckpoint(self.db)
             
             print(f"成功連接到 MongoDB: {self.mongo_db_name}")
         except Exception as e:
@@ -61,90 +114,55 @@ class CTSNewsLineNotifier:
             self.mongo_client = None
             self.db = None
             
-    def fetch_xml_data(self):
-        """從XML URL獲取RSS數據"""
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
+    def setup_history_retention(self):
+        """以 push_time 的TTL索引限制推送歷史的保留期間
+        
+        保留天數需大於新聞留在Feed中的時間，否則舊新聞可能被重複推送。
+        索引已存在但保留天數不同時，以 collMod 更新設定；不限保留期間時刪除先前建立的TTL索引。
+        無法設定時只輸出錯誤，不影響其他資料庫功能。
+        """
+        if not self.history_retention_days:
+            try:
+                self.push_history_collection.drop_index("push_time_ttl")
+            except OperationFailure:
+                # 索引不存在
+                pass
+            print("推送歷史永久保留")
+            return
         
+        expire_seconds = int(self.history_retention_days * 86400)
         try:
-            print(f"正在獲取XML: {self.xml_url}")
-            response = requests.get(self.xml_url, headers=headers, timeout=15)
-            
-            if response.status_code == 200:
-                print(f"成功獲取XML，內容長度: {len(response.text)} 字節")
-                return response.text
-            else:
-                print(f"獲取XML失敗: HTTP {response.status_code}")
-                return None
-        except Exception as e:
-            print(f"獲取XML時發生錯誤: {e}")
-            return None
+            try:
+                self.push_history_collection.create_index(
+                    [("push_time", 1)], name="push_time_ttl", expireAfterSeconds=expire_seconds
+                )
+            except OperationFailure:
+                # 索引已存在但設定不同
+                self.db.command(
+                    "collMod", self.push_history_collection.name,
+                    index={"name": "push_time_ttl", "expireAfterSeconds": expire_seconds}
+                )
+        except OperationFailure as e:
+            # 例如 push_time 已有其他名稱的索引
+            print(f"設定推送歷史保留期間時發生錯誤，推送歷史將不會自動刪除: {e}")
+            return
+        print(f"推送歷史保留 {self.history_retention_days} 天")
     
-    def parse_xml(self, xml_data):
-        """解析華視新聞XML格式"""
+    def parse_xml(self, xml_data, limit=None):
+        """以串流方式解析華視新聞XML格式
+        
+        @param xml_data: XML文字或逐段的位元組序列
+        @param limit: 最多解析的新聞數量，達到後立即停止
+        @return: Article 列表
+        @raise: 下載中斷或XML格式錯誤時拋出例外，讓 FeedFetcher 不保存這次的結果
+        """
         if not xml_data:
             return []
         
         try:
-            root = ET.fromstring(xml_data)
-            
-            # 尋找所有文章
-            articles = root.findall('article')
-            print(f"找到 {len(articles)} 篇文章")
-            
-            if not articles:
-                # 如果沒有直接的article子元素，嘗試深度搜索
-                articles = root.findall('.//article')
-                print(f"深度搜索後找到 {len(articles)} 篇文章")
-            
-            news_items = []
-            categories_found = set()
-            
-            for article in articles:
-                # 提取新聞基本信息
-                article_id = self.get_element_text(article, 'ID')
-                
-                # 提取標題 (可能在CDATA中)
-                title_elem = article.find('title')
-                title = ""
-                if title_elem is not None:
-                    if title_elem.text:
-                        title = title_elem.text
-                    else:
-                        # 嘗試獲取CDATA
-                        for child in title_elem:
-                            if child.tag == 'CDATA' and child.text:
-                                title = child.text
-                                break
-                
-                # 提取類別
-                category = self.get_element_text(article, 'category')
-                if category:
-                    categories_found.add(category)
-                
-                # 提取發布時間和更新時間
-                publish_time_unix = self.get_element_text(article, 'publishTimeUnix')
-                update_time_unix = self.get_element_text(article, 'updateTimeUnix')
-                
-                publish_time = self.show_datetime(publish_time_unix) if publish_time_unix else ""
-                update_time = self.show_datetime(update_time_unix) if update_time_unix else ""
-                
-                # 提取縮略圖
-                thumbnail = self.get_element_text(article, 'thumbnail')
-                
-                # 提取源URL
-                source_url = self.get_element_text(article, 'sourceUrl')
-                
-                news_items.append({
-                    'id': article_id,
-                    'title': title,
-                    'category': category,
-                    'publish_time': publish_time,
-                    'update_time': update_time,
-                    'thumbnail': thumbnail,
-                    'link': source_url,
-                })
+            # 使用與 app 共用的串流解析器，產生 Article 列表
+            news_items = parse_feed(xml_data, limit=limit)
+            categories_found = {news.category for news in news_items if news.category}
             
             print(f"找到的類別: {categories_found}")
             print(f"總共解析了 {len(news_items)} 篇文章")
@@ -153,37 +171,32 @@ class CTSNewsLineNotifier:
         except Exception as e:
             print(f"解析XML時發生錯誤: {e}")
             traceback.print_exc()
-            return []
-    
-    def get_element_text(self, parent, tag_name):
-        """安全地獲取元素文本"""
-        elem = parent.find(tag_name)
-        if elem is not None and elem.text:
-            return elem.text.strip()
-        return ""
-    
-    def show_datetime(self, unix_time_ms):
-        """將毫秒級Unix時間戳轉為可讀格式"""
-        try:
-            unix_time_sec = int(unix_time_ms) / 1000  # 轉換為秒
-            dt = datetime.datetime.fromtimestamp(unix_time_sec)
-            return dt.strftime('%Y-%m-%d %H:%M:%S')
-        except:
-            return ""
+            raise
     
     def get_latest_news(self):
-        """即時獲取最新新聞，不儲存資料庫"""
-        xml_data = self.fetch_xml_data()
-        if not xml_data:
+        """即時獲取最新新聞，不儲存資料庫（Feed未更新時沿用上一次的解析結果）"""
+        try:
+            news_items = self.feed_fetcher.fetch()
+        except Exception as e:
+            print(f"獲取XML時發生錯誤: {e}")
             return []
         
-        news_items = self.parse_xml(xml_data)
         if not news_items:
             return []
             
         print(f"成功獲取 {len(news_items)} 篇最新新聞")
         return news_items
     
+    def get_latest_feed(self):
+        """即時獲取最新新聞並建立類別索引
+        
+        @return: FeedIndex，無法取得新聞時回傳None
+        """
+        news_items = self.get_latest_news()
+        if not news_items:
+            return None
+        return FeedIndex(news_items)
+    
     def update_user_preference(self, user_id, categories):
         """更新用戶偏好設定
         
@@ -243,25 +256,53 @@ class CTSNewsLineNotifier:
         
         return result
     
-    def get_news_by_preference(self, user_id, limit=10):
-        """根據用戶偏好即時獲取新聞
+    def iter_user_pages(self, page_size=5000):
+        """依 user_id 順序分頁讀取所有用戶的偏好，不會一次載入全部用戶
+        
+        以上一頁最後的 user_id 作為下一頁的起點（keyset分頁），不需保持長時間開啟的游標。
+        
+        @param page_size: 每頁的用戶數量
+        @return: 逐頁產生 {user_id: {"categories": [...]}}
+        """
+        last_user_id = None
+        while True:
+            query = {"user_id": {"$gt": last_user_id}} if last_user_id is not None else {}
+            page = {
+                user_doc["user_id"]: {"categories": user_doc.get("categories", [])}
+                for user_doc in self.user_collection.find(
+                    query, {"user_id": 1, "categories": 1, "_id": 0}
+                ).sort("user_id", 1).limit(page_size)
+            }
+            if not page:
+                return
+            # 先記下分頁資訊，呼叫端可能會修改產生的字典
+            is_last_page = len(page) < page_size
+            last_user_id = max(page)
+            yield page
+            if is_last_page:
+                return
+    
+    def get_news_by_preference(self, user_id, limit=10, feed=None):
+        """根據用戶偏好獲取新聞
         
         @param user_id: LINE用戶ID
         @param limit: 獲取新聞數量限制
+        @param feed: 使用的Feed快照（FeedIndex）；None表示即時獲取最新新聞
         @return: 符合偏好的新聞列表
         """
         # 獲取用戶偏好
         preferences = self.get_user_preferences(user_id)
         user_categories = preferences.get(user_id, {}).get("categories", []) if preferences else []
         
-        # 獲取最新新聞
-        all_news = self.get_latest_news() or []
-        if not all_news:
+        # 獲取最新新聞索引
+        if feed is None:
+            feed = self.get_latest_feed()
+        if not feed:
             return []
         
         # 如果用戶沒有偏好，直接返回最新新聞
         if not user_categories:
-            return all_news[:limit]
+            return feed.articles[:limit]
         
         # 獲取推送歷史中的新聞ID
         pushed_news_ids = set()
@@ -272,66 +313,91 @@ class CTSNewsLineNotifier:
             ))
             pushed_news_ids = {item["news_id"] for item in pushed_history}
         
-        # 按類別分組
-        filtered_news_by_category = {category: [] for category in user_categories}
+        return self.select_news(feed, user_categories, pushed_news_ids, limit)
+    
+    def load_pushed_news_index(self, feed, user_ids):
+        """一次查詢一頁用戶在Feed快照中的推送歷史，建立 用戶 → 已推送新聞ID 的索引
+        
+        只查詢目前Feed中出現的新聞ID，不載入已不在Feed中的舊紀錄，
+        每頁用戶只需要一次資料庫查詢（以游標分批讀取，使用 (user_id, news_id) 索引）。
         
-        # 將新聞分配到對應類別
-        for news in all_news:
-            if news['id'] in pushed_news_ids:
-                continue
-                
-            category = news['category']
-            if category in user_categories:
-                filtered_news_by_category[category].append(news)
+        @param feed: Feed快照（FeedIndex）
+        @param user_ids: 要查詢的用戶ID
+        @return: {user_id: 已推送的新聞ID集合}
+        """
+        pushed_index = {}
+        if not self.mongo_client:
+            return pushed_index
+        
+        cursor = self.push_history_collection.find(
+            {"user_id": {"$in": list(user_ids)}, "news_id": {"$in": list(feed.by_id)}},
+            {"user_id": 1, "news_id": 1, "_id": 0},
+            batch_size=10000
+        )
+        for item in cursor:
+            pushed_index.setdefault(item["user_id"], set()).add(item["news_id"])
+        
+        return pushed_index
+    
+    def select_news(self, feed, user_categories, pushed_news_ids, limit=10):
+        """依偏好類別從Feed快照挑選未推送過的新聞（不存取資料庫與網路）
+        
+        @param feed: Feed快照（FeedIndex）
+        @param user_categories: 用戶偏好的新聞類別列表
+        @param pushed_news_ids: 已推送過的新聞ID集合
+        @param limit: 獲取新聞數量限制
+        @return: 新聞列表
+        """
+        # 沒有偏好時直接返回最新新聞
+        if not user_categories:
+            return feed.articles[:limit]
+        
+        # 從索引取出各偏好類別中未推送過的新聞，每類最多取 limit 則
+        filtered_news_by_category = {
+            category: list(islice(
+                (news for news in feed.iter_category(category) if news.id not in pushed_news_ids),
+                limit
+            ))
+            for category in user_categories
+        }
         
         # 平均分配每個類別的新聞
         result_news = []
-        if user_categories:
-            # 計算每個類別的基本配額
-            quota_per_category = max(1, limit // len(user_categories))
-            remaining = limit
-            
-            # 第一輪：分配基本配額
-            for category in user_categories:
-                category_news = filtered_news_by_category.get(category, [])
-                news_to_add = min(quota_per_category, len(category_news), remaining)
-                result_news.extend(category_news[:news_to_add])
-                remaining -= news_to_add
-            
-            # 第二輪：分配剩餘配額
-            if remaining > 0:
-                category_index = 0
-                categories = list(user_categories)
-                while remaining > 0 and category_index < len(categories):
-                    category = categories[category_index]
-                    category_news = filtered_news_by_category.get(category, [])
-                    already_added = min(quota_per_category, len(category_news))
-                    
-                    if already_added < len(category_news):
-                        result_news.append(category_news[already_added])
-                        remaining -= 1
-                        # 不增加category_index，繼續在同一類別分配
-                    else:
-                        category_index += 1
+        # 計算每個類別的基本配額
+        quota_per_category = max(1, limit // len(user_categories))
+        remaining = limit
+        taken = {}
+        
+        # 第一輪：分配基本配額
+        for category in user_categories:
+            category_news = filtered_news_by_category[category]
+            news_to_add = min(quota_per_category, len(category_news), remaining)
+            result_news.extend(category_news[:news_to_add])
+            taken[category] = news_to_add
+            remaining -= news_to_add
+        
+        # 第二輪：依類別順序分配剩餘配額
+        for category in user_categories:
+            if remaining <= 0:
+                break
+            category_news = filtered_news_by_category[category]
+            extra = category_news[taken[category]:taken[category] + remaining]
+            result_news.extend(extra)
+            remaining -= len(extra)
         
         # 如果還不夠，用其他未推送過的新聞填充（確保不重複添加）
         if len(result_news) < limit:
-            used_news_ids = {news['id'] for news in result_news}
-            other_news = []
+            used_news_ids = {news.id for news in result_news}
             
-            # 遍歷所有新聞，找出未被使用過且未推送過的
-            for news in all_news:
-                if (news['id'] not in pushed_news_ids and 
-                    news['id'] not in used_news_ids and
-                    news not in result_news):  # 額外檢查防止重複
-                    other_news.append(news)
-                    used_news_ids.add(news['id'])  # 更新已使用ID集合
+            # 依Feed順序找出未被使用過且未推送過的新聞
+            for news in feed.articles:
+                if news.id not in pushed_news_ids and news.id not in used_news_ids:
+                    result_news.append(news)
+                    used_news_ids.add(news.id)
                     
                     # 達到所需數量就停止
-                    if len(other_news) >= (limit - len(result_news)):
+                    if len(result_news) >= limit:
                         break
-                        
-            result_news.extend(other_news)
         
         return result_news[:limit]
     
@@ -387,7 +453,7 @@ class CTSNewsLineNotifier:
                         "contents": [
                             {
                                 "type": "image",
-                                "url": news.get('thumbnail') if news.get('thumbnail') else "https://via.placeholder.com/100x100.png?text=CTS+News",
+                                "url": news.thumbnail or "https://via.placeholder.com/100x100.png?text=CTS+News",
                                 "aspectMode": "cover",
                                 "aspectRatio": "1:1",
                                 "size": "full",
@@ -411,7 +477,7 @@ class CTSNewsLineNotifier:
                                 "contents": [
                                     {
                                         "type": "text",
-                                        "text": news.get('category', '即時'),
+                                        "text": news.category or '即時',
                                         "size": "xs",
                                         "color": "#ffffff",
                                         "align": "center",
@@ -428,7 +494,7 @@ class CTSNewsLineNotifier:
                             # 標題
                             {
                                 "type": "text",
-                                "text": news.get('title', ''),
+                                "text": news.title,
                                 "size": "sm",
                                 "color": "#111111",
                                 "margin": "sm",
@@ -457,7 +523,7 @@ class CTSNewsLineNotifier:
                 "action": {
                     "type": "uri",
                     "label": "action",
-                    "uri": news.get('link', 'https://news.cts.com.tw/')
+                    "uri": news.link or 'https://news.cts.com.tw/'
                 }
             }
             
@@ -476,69 +542,244 @@ class CTSNewsLineNotifier:
             contents=bubble
         )
     
-    def push_news_to_user(self, user_id, news_count=10):
+    def push_news_to_user(self, user_id, news_count=10, feed=None):
         """推送新聞給用戶
         
         @param user_id: LINE用戶ID
         @param news_count: 推送的新聞數量
+        @param feed: 使用的Feed快照（FeedIndex）；None表示即時獲取最新新聞
         @return: 推送結果
         """
         if not self.line_bot_api:
             return "LINE API未設置"
         
         # 獲取用戶偏好的新聞
-        news_items = self.get_news_by_preference(user_id, news_count)
+        news_items = self.get_news_by_preference(user_id, news_count, feed)
         if not news_items:
             print(f"沒有找到用戶 {user_id} 偏好的新聞")
             return "沒有找到符合偏好的新聞"
         
-        push_time = datetime.datetime.now()
+        # 發送問候訊息與新聞列表 (所有新聞在一條Flex Message中)，並記錄推送歷史
+        flex_message = self.create_news_flex_message(news_items)
+        if not self.push_digest([user_id], news_items, flex_message):
+            return "推送失敗"
+        
+        print(f"成功推送 {len(news_items)} 則新聞給用戶 {user_id}")
+        return f"成功推送 {len(news_items)} 則新聞"
+    
+    def build_cohorts(self, user_preferences, feed, pushed_index, news_count=10):
+        """依挑選結果將用戶分組，挑到完全相同新聞的用戶屬於同一組
+        
+        @param user_preferences: {user_id: {"categories": [...]}}
+        @param feed: Feed快照（FeedIndex）
+        @param pushed_index: load_pushed_news_index() 的結果
+        @param news_count: 每位用戶推送的新聞數量
+        @return: ([(新聞列表, 用戶ID列表)], 沒有可推送新聞的用戶數)
+        """
+        cohorts = {}
+        skipped = 0
+        no_history = frozenset()
+        for user_id, prefs in user_preferences.items():
+            news_items = self.select_news(
+                feed, prefs.get("categories", []), pushed_index.get(user_id, no_history), news_count
+            )
+            if not news_items:
+                skipped += 1
+                continue
+            key = tuple(news.id for news in news_items)
+            cohort = cohorts.get(key)
+            if cohort is None:
+                cohort = cohorts[key] = (news_items, [])
+            cohort[1].append(user_id)
+        return list(cohorts.values()), skipped
+    
+    def push_digest(self, user_ids, news_items, flex_message, history_writer=None, request_key=None):
+        """將同一份新聞摘要推送給一組用戶（最多 MULTICAST_LIMIT 人）
+        
+        問候訊息與新聞摘要打包在同一個請求中送出，兩則訊息一起送達或一起失敗；
+        只有一位用戶時使用 push_message，否則使用 multicast。
+        
+        @param user_ids: 用戶ID列表
+        @param news_items: 新聞列表
+        @param flex_message: 已建立的新聞Flex訊息
+        @param history_writer: 推送歷史的 BatchWriter；None表示立即寫入
+        @param request_key: 這次推送的識別字串，相同的字串產生相同的 retry key，
+                            LINE不會重複送出已接受的請求；None表示每次使用新的 retry key
+        @return: 是否推送成功
+        """
+        if self.push_limiter is not None:
+            self.push_limiter.acquire()
         
+        messages = [TextSendMessage(text=GREETING_TEXT), flex_message]
         try:
-            # 1. 發送問候訊息
-            greeting_message = "早安！以下是今天的重點新聞："
-            self.line_bot_api.push_message(user_id, TextSendMessage(text=greeting_message))
-            
-            # 2. 發送新聞列表 (所有新聞在一條Flex Message中)
-            flex_message = self.create_news_flex_message(news_items)
-            self.line_bot_api.push_message(user_id, flex_message)
-            
-            # 記錄推送歷史到MongoDB
-            if self.mongo_client:
-                for item in news_items:
-                    self.push_history_collection.insert_one({
-                        "user_id": user_id,
-                        "news_id": item['id'],
-                        "push_time": push_time,
-                        "news_title": item['title'],
-                        "news_category": item['category']
-                    })
-            
-            print(f"成功推送 {len(news_items)} 則新聞給用戶 {user_id}")
-            return f"成功推送 {len(news_items)} 則新聞"
-            
+            for i, request_messages in enumerate(pack_messages(messages)):
+                retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{request_key}:{i}")) if request_key else None
+                if len(user_ids) == 1:
+                    self.line_bot_api.push_message(user_ids[0], request_messages, retry_key=retry_key)
+                else:
+                    self.line_bot_api.multicast(user_ids, request_messages, retry_key=retry_key)
         except LineBotApiError as e:
-            print(f"推送新聞時發生錯誤: {e}")
-            return f"推送失敗: {str(e)}"
+            print(f"推送新聞給 {len(user_ids)} 位用戶時發生錯誤: {e}")
+            return False
+        
+        # 記錄推送歷史到MongoDB
+        if self.mongo_client:
+            push_time = datetime.datetime.now()
+            history = [{
+                "user_id": user_id,
+                "news_id": item.id,
+                "push_time": push_time,
+                "news_title": item.title,
+                "news_category": item.category
+            } for user_id in user_ids for item in news_items]
+            if history_writer is not None:
+                history_writer.add(history)
+            else:
+                self.push_history_collection.insert_many(history, ordered=False)
+        return True
     
-    def daily_morning_push(self):
-        """每日早上推送新聞給所有用戶"""
-        print(f"開始執行每日早上新聞推送任務: {datetime.datetime.now()}")
-        
-        # 獲取所有用戶
-        user_preferences = self.get_user_preferences()
-        if not user_preferences:
-            print("沒有找到用戶")
-            return
+    def _push_batch(self, run_id, user_ids, news_items, flex_message, history_writer):
+        """推送一批用戶並記錄執行進度
         
-        # 逐一推送 (不需先更新資料庫，因為每次都會即時獲取)
-        for user_id in user_preferences:
-            result = self.push_news_to_user(user_id, 10)
-            print(f"用戶 {user_id} 推送結果: {result}")
-            time.sleep(1)  # 避免過於頻繁的API調用
+        retry key 由執行ID與用戶決定：LINE已接受但尚未記錄完成時中斷，接續執行送出的
+        相同批次會被LINE視為重複請求（409），不會再次送達。
+        """
+        request_key = f"{run_id}:{','.join(user_ids)}"
+        if not self.push_digest(user_ids, news_items, flex_message, history_writer, request_key):
+            return False
+        self.push_checkpoint.mark_completed(run_id, user_ids)
+        return True
+    
+    def daily_morning_push(self, news_count=10, progress_interval=10, run_id=None):
+        """每日早上推送新聞給所有用戶
+        
+        開始時只下載並解析一次Feed，所有用戶共用同一份快照，內容一致。
+        用戶依 user_id 分頁讀取，每頁的推送歷史以一次查詢載入，新的推送歷史則跨用戶
+        累積後以 insert_many 批次寫入。挑到相同新聞的用戶歸為同一組，每組只建立一次
+        Flex訊息，並以 multicast 每次最多推送給 MULTICAST_LIMIT 位用戶；各批次由執行緒池
+        同時送出，並以 push_rate 限制整體請求速率。
+        
+        每批推送成功後立即記錄已完成的用戶；程式中斷後以相同的 run_id 重新執行時
+        只會推送尚未完成的用戶（包含上次推送失敗的用戶）。所有用戶都推送成功時
+        才標記執行完成，已完成的執行不會重複推送。
+        
+        @param news_count: 每位用戶推送的新聞數量
+        @param progress_interval: 輸出進度的間隔秒數
+        @param run_id: 執行ID，預設為當天日期
+        @return: 推送統計 {"total", "success", "skipped", "failed", "resumed", "cohorts", "requests",
+                 "history_written", "history_failed", "seconds"}；無法執行或已完成時回傳None
+        """
+        started = time.perf_counter()
+        run_id = run_id or datetime.date.today().isoformat()
+        print(f"開始執行每日早上新聞推送任務: {datetime.datetime.now()} (執行ID: {run_id})")
+        
+        if not self.line_bot_api:
+            print("LINE API未設置")
+            return None
+        if not self.mongo_client:
+            print("MongoDB未連接，無法讀取用戶")
+            return None
+        
+        run = self.push_checkpoint.start(run_id)
+        if run is None:
+            print(f"執行 {run_id} 已完成，不再重複推送")
+            return None
+        if run.get("attempts", 1) > 1:
+            print(f"接續執行 {run_id}（第 {run['attempts']} 次），將略過已完成的用戶")
+        
+        # 本次推送共用的Feed快照
+        feed = self.get_latest_feed()
+        if not feed:
+            print("無法獲取新聞，取消本次推送")
+            return None
+        print(f"本次推送使用的Feed快照共 {len(feed)} 則新聞")
+        
+        total = self.user_collection.estimated_document_count()
+        stats = {
+            "total": 0, "success": 0, "skipped": 0, "failed": 0, "resumed": 0,
+            "cohorts": 0, "requests": 0
+        }
+        last_report = started
+        
+        # 跨用戶累積的推送歷史，滿一批才寫入
+        history_writer = BatchWriter(self.push_history_collection, self.history_batch_size)
+        
+        with ThreadPoolExecutor(max_workers=self.push_workers, thread_name_prefix="push-worker") as executor:
+            for page in self.iter_user_pages(self.push_page_size):
+                stats["total"] += len(page)
+                
+                # 略過此次執行中已完成的用戶
+                completed = self.push_checkpoint.completed_users(run_id, page)
+                for user_id in completed:
+                    del page[user_id]
+                stats["resumed"] += len(completed)
+                
+                # 載入這頁用戶的推送歷史，並依挑選結果分組，同一組只建立一次Flex訊息
+                pushed_index = self.load_pushed_news_index(feed, page)
+                cohorts, skipped = self.build_cohorts(page, feed, pushed_index, news_count)
+                stats["skipped"] += skipped
+                stats["cohorts"] += len(cohorts)
+                
+                futures = {}
+                for news_items, user_ids in cohorts:
+                    flex_message = self.create_news_flex_message(news_items)
+                    for i in range(0, len(user_ids), MULTICAST_LIMIT):
+                        batch = user_ids[i:i + MULTICAST_LIMIT]
+                        future = executor.submit(self._push_batch, run_id, batch, news_items, flex_message, history_writer)
+                        futures[future] = batch
+                stats["requests"] += len(futures)
+                
+                for future in as_completed(futures):
+                    user_ids = futures[future]
+                    try:
+                        succeeded = future.result()
+                    except Exception as e:
+                        print(f"推送新聞給 {len(user_ids)} 位用戶時發生錯誤: {e}")
+                        traceback.print_exc()
+                        succeeded = False
+                    stats["success" if succeeded else "failed"] += len(user_ids)
+                    
+                    # 定期輸出進度
+                    now = time.perf_counter()
+                    if now - last_report >= progress_interval:
+                        last_report = now
+                        elapsed = now - started
+                        done = stats["success"] + stats["failed"] + stats["skipped"] + stats["resumed"]
+                        print(f"推送進度: {done}/{max(total, done)} ({done / max(total, done, 1):.0%})，"
+                              f"已耗時 {elapsed:.1f} 秒，{done / elapsed if elapsed else 0:.1f} 位用戶/秒")
+                
+                # 每頁結束時寫入推送歷史，中斷時最多只遺失一頁的紀錄
+                history_writer.flush()
+        
+        stats["history_written"] = history_writer.written
+        stats["history_failed"] = history_writer.failed
+        stats["seconds"] = round(time.perf_counter() - started, 3)
+        if not self.push_checkpoint.finish(run_id, stats):
+            print(f"有 {stats['failed']} 位用戶推送失敗，執行 {run_id} 保留為未完成，重新執行時會重試這些用戶")
+        
+        print(f"每日推送完成: 共 {stats['total']} 位用戶，成功 {stats['success']}，略過 {stats['skipped']}，"
+              f"失敗 {stats['failed']}，先前已完成 {stats['resumed']}，耗時 {stats['seconds']} 秒"
+              f"（{stats['total'] / stats['seconds'] if stats['seconds'] else 0:.1f} 位用戶/秒）")
+        return stats
+    
+    def resume_unfinished_run(self):
+        """接續今天已開始但未完成的推送（程式中斷或有用戶推送失敗）
+        
+        @return: 推送統計；沒有需要接續的執行時回傳None
+        """
+        if not self.push_checkpoint:
+            return None
+        run_id = datetime.date.today().isoformat()
+        if not self.push_checkpoint.is_unfinished(run_id):
+            return None
+        print(f"發現今天未完成的推送 {run_id}，立即接續執行")
+        return self.daily_morning_push(run_id=run_id)
     
     def start_scheduler(self):
         """啟動排程器"""
+        # 排程器重新啟動時，先接續今天中斷的推送，不必等到明天
+        self.resume_unfinished_run()
+        
         # 設定每天早上7點執行推送任務
         schedule.every().day.at("07:00").do(self.daily_morning_push)
         
@@ -566,11 +807,32 @@ if __name__ == "__main__":
     line_channel_access_token = config.get('LINE_CHANNEL_ACCESS_TOKEN', 'YOUR_CHANNEL_ACCESS_TOKEN')
     line_channel_secret = config.get('LINE_CHANNEL_SECRET', 'YOUR_CHANNEL_SECRET')
     
-    # 初始化LINE Bot API
-    line_bot_api = LineBotApi(line_channel_access_token)
+    # 所有對外HTTP請求共用連線池與逾時設定
+    http_client.configure(
+        connect_timeout=float(config.get('HTTP_CONNECT_TIMEOUT') or 5),
+        read_timeout=float(config.get('HTTP_READ_TIMEOUT') or 15),
+        pool_maxsize=int(config.get('HTTP_POOL_MAXSIZE') or 10)
+    )
+    
+    # 初始化LINE Bot API（透過共用HTTP用戶端重用連線，並依方案額度限制速率、自動重試）
+    line_bot_api = RateLimitedLineBotApi(
+        line_channel_access_token,
+        rate=float(config.get('LINE_API_RATE') or 200),
+        burst=int(config.get('LINE_API_BURST') or 0) or None,
+        max_retries=int(config.get('LINE_API_MAX_RETRIES') or 3),
+        http_client=PooledLineHttpClient
+    )
     
-    # 建立通知器實例
-    notifier = CTSNewsLineNotifier(xml_url, mongo_uri, mongo_db, line_bot_api)
+    # 建立通知器實例（每日推送的並行數與整體推送速率）
+    notifier = CTSNewsLineNotifier(
+        xml_url, mongo_uri, mongo_db, line_bot_api,
+        push_workers=int(config.get('PUSH_WORKERS') or 8),
+        push_rate=float(config.get('PUSH_RATE') or 0) or None,
+        # 未設定時保留30天，設為0表示永久保留
+        history_retention_days=int(config.get('PUSH_HISTORY_RETENTION_DAYS') or 30) or None,
+        history_batch_size=int(config.get('PUSH_HISTORY_BATCH_SIZE') or 500),
+        push_page_size=int(config.get('PUSH_PAGE_SIZE') or 5000)
+    )
     
     # 示例: 添加一個測試用戶及其偏好
     test_user_id = "U1234567890abcdef1234567890abcdef"  # 測試用戶ID
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+from local_cache import TTLCache
+
+
+class MemorySessionStore:
+    """單一行程內的使用者上下文，有容量上限與存活時間"""
+
+    def __init__(self, max_size=10000, ttl=1800):
+        """
+        @param max_size: 最多保存的使用者數量，超過時淘汰最久未使用的使用者
+        @param ttl: 每筆上下文的存活秒數
+        """
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    def get(self, user_id, default=None):
+        """取得使用者上下文，不存在或已過期時回傳 default"""
+        return self._cache.get(user_id, default)
+
+    def set(self, user_id, value):
+        """設定使用者上下文"""
+        self._cache.set(user_id, value)
+
+    def delete(self, user_id):
+        """刪除使用者上下文"""
+        self._cache.delete(user_id)
+
+
+class SQLiteSessionStore:
+    """以本機SQLite檔案在多個worker行程間共用的使用者上下文
+
+    每筆資料有存活時間，並記錄最後存取時間；超過容量時淘汰最久未使用的使用者。
+    """
+
+    # 每寫入多少次清理一次過期與超量的資料
+    PRUNE_EVERY = 100
+
+    def __init__(self, path="./sessions.db", max_size=10000, ttl=1800):
+        """
+        @param path: SQLite檔案路徑
+        @param max_size: 最多保存的使用者數量
+        @param ttl: 每筆上下文的存活秒數
+        """
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._local = threading.local()
+        self._writes = 0
+
+        # 建立資料表
+        self._connect()
+
+    def _connect(self):
+        """取得目前執行緒的連線（fork後的子行程會重新連線）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_context ("
+            "user_id TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_context_accessed ON user_context (accessed_at)")
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, user_id, default=None):
+        """取得使用者上下文，不存在或已過期時回傳 default"""
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires_at FROM user_context WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return default
+
+        # 更新最後存取時間，作為LRU淘汰依據
+        conn.execute("UPDATE user_context SET accessed_at = ? WHERE user_id = ?", (now, user_id))
+        return row[0]
+
+    def set(self, user_id, value):
+        """設定使用者上下文"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO user_context (user_id, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (user_id, value, now + self.ttl, now)
+        )
+
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete(self, user_id):
+        """刪除使用者上下文"""
+        self._connect().execute("DELETE FROM user_context WHERE user_id = ?", (user_id,))
+
+    def prune(self):
+        """刪除過期資料，並在超過容量時淘汰最久未使用的使用者"""
+        conn = self._connect()
+        conn.execute("DELETE FROM user_context WHERE expires_at <= ?", (time.time(),))
+        count = conn.execute("SELECT COUNT(*) FROM user_context").fetchone()[0]
+        if count > self.max_size:
+            conn.execute(
+                "DELETE FROM user_context WHERE user_id IN "
+                "(SELECT user_id FROM user_context ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_size,)
+            )
+
+
+def create_session_store(backend="memory", path="./sessions.db", max_size=10000, ttl=1800):
+    """依設定建立使用者上下文儲存
+
+    @param backend: "memory"（單一行程）或 "sqlite"（多個worker行程共用）
+    """
+    if backend == "sqlite":
+        return SQLiteSessionStore(path, max_size=max_size, ttl=ttl)
+    return MemorySessionStore(max_size=max_size, ttl=ttl)
@@ -0,0 +1,190 @@
+import threading
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error, FlexSendMessage, TextSendMessage
+
+from bench_webhook import FeedFixtureServer, build_feed_xml
+
+mongomock = pytest.importorskip('mongomock')
+
+RUN_ID = '2026-01-01'
+
+
+class FakeLineBotApi:
+    """記錄推送請求的 LineBotApi 替身，可指定推送失敗的用戶"""
+
+    def __init__(self, failing_users=()):
+        self.failing_users = set(failing_users)
+        self.calls = []
+        self.retry_keys = []
+        self._lock = threading.Lock()
+
+    def _send(self, method, to, messages, **kwargs):
+        recipients = [to] if method == 'push_message' else list(to)
+        if self.failing_users.intersection(recipients):
+            raise LineBotApiError(500, {}, error=Error(message='fake failure'))
+        with self._lock:
+            self.calls.append((method, recipients, messages))
+            self.retry_keys.append(kwargs.get('retry_key'))
+
+    def push_message(self, to, messages, **kwargs):
+        self._send('push_message', to, messages, **kwargs)
+
+    def multicast(self, to, messages, **kwargs):
+        self._send('multicast', to, messages, **kwargs)
+
+    def recipients(self):
+        return [user_id for _, user_ids, _ in self.calls for user_id in user_ids]
+
+
+@pytest.fixture
+def feed_url():
+    server = FeedFixtureServer(build_feed_xml(100))
+    yield server.url
+    server.close()
+
+
+@pytest.fixture
+def make_notifier(monkeypatch, notifier_module, feed_url):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(notifier_module, 'MongoClient', lambda uri: client)
+
+    def make(line_bot_api, preferences):
+        notifier = notifier_module.CTSNewsLineNotifier(
+            feed_url, 'mongodb://localhost', 'test', line_bot_api, push_workers=4
+        )
+        for user_id, categories in preferences.items():
+            notifier.update_user_preference(user_id, categories)
+        return notifier
+
+    return make
+
+
+def test_identical_selections_share_one_multicast(make_notifier):
+    api = FakeLineBotApi()
+    preferences = {f"U{i:03d}": ["政治"] for i in range(3)}
+    preferences["U100"] = ["運動"]
+    notifier = make_notifier(api, preferences)
+
+    stats = notifier.daily_morning_push(run_id=RUN_ID)
+
+    assert stats["success"] == 4 and stats["cohorts"] == 2 and stats["requests"] == 2
+    calls = sorted(api.calls, key=lambda call: call[0])
+    assert [(method, sorted(user_ids)) for method, user_ids, _ in calls] == [
+        ("multicast", ["U000", "U001", "U002"]),
+        ("push_message", ["U100"]),
+    ]
+    # 問候訊息與新聞摘要在同一個請求中送出
+    for _, _, messages in calls:
+        assert len(messages) == 2
+        assert isinstance(messages[0], TextSendMessage) and isinstance(messages[1], FlexSendMessage)
+
+
+def test_multicast_is_chunked_to_the_limit(monkeypatch, make_notifier, notifier_module):
+    # LINE multicast 每次最多500位收件人；測試時縮小上限以減少資料量
+    assert notifier_module.MULTICAST_LIMIT == 500
+    monkeypatch.setattr(notifier_module, 'MULTICAST_LIMIT', 4)
+
+    api = FakeLineBotApi()
+    preferences = {f"U{i:03d}": [] for i in range(9)}
+    notifier = make_notifier(api, preferences)
+
+    stats = notifier.daily_morning_push(run_id=RUN_ID)
+
+    assert stats["success"] == 9 and stats["cohorts"] == 1 and stats["requests"] == 3
+    assert sorted(len(user_ids) for _, user_ids, _ in api.calls) == [1, 4, 4]
+    assert sorted(api.recipients()) == sorted(preferences)
+
+
+def test_failed_batches_are_retried_on_resume(make_notifier):
+    api = FakeLineBotApi(failing_users={"U100"})
+    preferences = {f"U{i:03d}": ["政治"] for i in range(3)}
+    preferences["U100"] = ["運動"]
+    notifier = make_notifier(api, preferences)
+
+    stats = notifier.daily_morning_push(run_id=RUN_ID)
+
+    assert stats["success"] == 3 and stats["failed"] == 1
+    # 推送失敗的用戶沒有推送歷史，也沒有記錄為已完成
+    assert notifier.push_history_collection.count_documents({"user_id": "U100"}) == 0
+    assert notifier.push_history_collection.count_documents({"user_id": "U000"}) == 10
+    assert notifier.push_checkpoint.completed_users(RUN_ID, preferences) == {"U000", "U001", "U002"}
+    assert notifier.push_checkpoint.is_unfinished(RUN_ID)
+
+    # 接續執行只推送上次失敗的用戶
+    api.failing_users.clear()
+    api.calls.clear()
+    stats = notifier.daily_morning_push(run_id=RUN_ID)
+
+    assert api.recipients() == ["U100"]
+    assert stats["resumed"] == 3 and stats["success"] == 1 and stats["failed"] == 0
+    assert not notifier.push_checkpoint.is_unfinished(RUN_ID)
+
+    # 已完成的執行不會再推送
+    api.calls.clear()
+    assert notifier.daily_morning_push(run_id=RUN_ID) is None
+    assert api.calls == []
+
+
+def test_interrupted_run_serves_only_remaining_users(make_notifier):
+    class CrashingLineBotApi(FakeLineBotApi):
+        """送出指定數量的請求後模擬程式中斷"""
+
+        def __init__(self, crash_after):
+            super().__init__()
+            self.crash_after = crash_after
+
+        def _send(self, method, to, messages, **kwargs):
+            with self._lock:
+                crash = self.crash_after is not None and len(self.calls) >= self.crash_after
+            if crash:
+                raise SystemExit("simulated crash")
+            super()._send(method, to, messages, **kwargs)
+
+    api = CrashingLineBotApi(crash_after=5)
+    categories = ["政治", "社會", "運動", "財經", "國際", "藝文", "旅遊", "氣象"]
+    preferences = {f"U{i:03d}": [category] for i, category in enumerate(categories * 3)}
+    notifier = make_notifier(api, preferences)
+
+    with pytest.raises(SystemExit):
+        notifier.daily_morning_push(run_id=RUN_ID)
+    first_run = api.recipients()
+    assert 0 < len(first_run) < len(preferences)
+
+    api.crash_after = None
+    api.calls.clear()
+    stats = notifier.daily_morning_push(run_id=RUN_ID)
+
+    # 每位用戶剛好收到一次推送
+    assert sorted(first_run + api.recipients()) == sorted(preferences)
+    assert stats["resumed"] == len(first_run)
+
+
+def test_resumed_batch_reuses_its_retry_key(monkeypatch, make_notifier):
+    api = FakeLineBotApi()
+    preferences = {f"U{i:03d}": ["政治"] for i in range(3)}
+    notifier = make_notifier(api, preferences)
+
+    # LINE已接受請求，但第一次記錄完成前程式中斷
+    mark_completed = notifier.push_checkpoint.mark_completed
+    crashed = []
+
+    def crash_once(run_id, user_ids):
+        if not crashed:
+            crashed.append(1)
+            raise SystemExit("simulated crash")
+        mark_completed(run_id, user_ids)
+
+    monkeypatch.setattr(notifier.push_checkpoint, 'mark_completed', crash_once)
+    with pytest.raises(SystemExit):
+        notifier.daily_morning_push(run_id=RUN_ID)
+
+    notifier.daily_morning_push(run_id=RUN_ID)
+
+    # 接續執行送出相同的 retry key，LINE會以409拒絕重複的請求
+    assert len(api.retry_keys) == 2 and api.retry_keys[0] == api.retry_keys[1]
+    assert api.retry_keys[0] is not None
+
+    other_run = notifier.daily_morning_push(run_id='2026-01-02')
+    assert other_run["success"] == 3 and api.retry_keys[2] != api.retry_keys[0]
@@ -0,0 +1,46 @@
+import time
+
+from news_feed import FeedCache
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_ttl_shorter_than_retry_interval_still_reloads():
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return len(loads)
+
+    cache = FeedCache(loader, ttl=0.1, retry_interval=10)
+    assert cache.get() == 1
+
+    time.sleep(0.15)
+    cache.get()
+    assert wait_for(lambda: cache.get() == 2)
+
+
+def test_failed_load_waits_for_retry_interval():
+    attempts = []
+
+    def loader():
+        attempts.append(1)
+        return 1 if len(attempts) == 1 else None
+
+    cache = FeedCache(loader, ttl=0.05, retry_interval=10)
+    assert cache.get() == 1
+
+    time.sleep(0.1)
+    cache.get()
+    assert wait_for(lambda: cache.status()["last_error"] is not None)
+
+    # 失敗後在 retry_interval 內不再重試，繼續回傳舊的內容
+    time.sleep(0.1)
+    assert cache.get() == 1
+    time.sleep(0.05)
+    assert len(attempts) == 2
@@ -0,0 +1,38 @@
+import news_feed
+from bench_webhook import FeedFixtureServer, build_feed_xml
+
+
+def test_unchanged_feed_is_parsed_once(monkeypatch, notifier_module):
+    server = FeedFixtureServer(build_feed_xml(50))
+    try:
+        # 記錄每次請求的HTTP狀態碼
+        statuses = []
+        original_get = news_feed.http_client.get
+
+        def recording_get(*args, **kwargs):
+            response = original_get(*args, **kwargs)
+            statuses.append(response.status_code)
+            return response
+
+        monkeypatch.setattr(news_feed.http_client, 'get', recording_get)
+
+        notifier = notifier_module.CTSNewsLineNotifier(server.url)
+
+        # 記錄 parse_xml 的呼叫次數
+        parse_calls = []
+        original_parser = notifier.feed_fetcher.parser
+
+        def counting_parser(xml_data, *args, **kwargs):
+            parse_calls.append(1)
+            return original_parser(xml_data, *args, **kwargs)
+
+        notifier.feed_fetcher.parser = counting_parser
+
+        results = [notifier.get_latest_news() for _ in range(3)]
+
+        assert statuses == [200, 304, 304]
+        assert len(parse_calls) == 1
+        assert [len(news_items) for news_items in results] == [50, 50, 50]
+        assert results[1] is results[0] and results[2] is results[0]
+    finally:
+        server.close()